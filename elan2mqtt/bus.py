@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import IO, Optional
+
+import aiomqtt
+import requests
+
+from config import Config
+from mqtt_client import OutboundQueue, PublishData
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Sink(ABC):
+    """
+    consumer of the published messages besides the broker, with its own bounded queue;
+    like the mqtt queue it keeps the latest message of each topic and drops by priority above its cap,
+    so a slow sink loses old states but never holds up the broker or the others
+    """
+
+    KINDS = ("status", "attribute", "availability", "discovery")
+
+    def __init__(self, name: str, settings: dict):
+        """
+        init sink
+        :param name: name of the sink, used in logs and task names
+        :param settings: sink entry of the sinks option
+        """
+        self.name = name
+        self.kinds = set(settings.get('kinds', self.KINDS))
+        self.queue = OutboundQueue(int(settings.get('max_kb', 256)) * 1024, "sink " + name)
+        self.pending: Optional[PublishData] = None
+        self.sent = 0
+
+    def wants(self, pdata: PublishData) -> bool:
+        return pdata.message in self.kinds
+
+    @abstractmethod
+    async def write(self, pdata: PublishData) -> None:
+        """deliver one message, OSError keeps it for a retry"""
+
+    async def run(self) -> None:
+        """deliver the queued messages in loop, a failed message is retried after a second"""
+        while True:
+            if self.pending is None:
+                await self.queue.wait()
+                self.pending = self.queue.get()
+            try:
+                await self.write(self.pending)
+            except OSError as e:
+                logger.error("sink {} failed: {}".format(self.name, str(e)))
+                await asyncio.sleep(1)
+                continue
+            self.pending = None
+            self.sent += 1
+
+
+class FileSink(Sink):
+    """appends the messages as json lines to a file"""
+
+    def __init__(self, name: str, settings: dict):
+        super().__init__(name, settings)
+        self.path = settings['path']
+        self.file: Optional[IO] = None
+
+    def _append(self, line: str) -> None:
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    async def write(self, pdata: PublishData) -> None:
+        line = json.dumps({"time": round(pdata.created, 3), "topic": pdata.topic, "kind": pdata.message,
+                           "payload": pdata.payload.decode("utf-8", errors="replace")})
+        await asyncio.to_thread(self._append, line)
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class WebhookSink(Sink):
+    """posts each payload to an url, the topic and kind are sent in the X-Topic and X-Kind headers"""
+
+    def __init__(self, name: str, settings: dict):
+        super().__init__(name, settings)
+        self.url = settings['url']
+        self.timeout = float(settings.get('timeout', 5))
+
+    def _post(self, pdata: PublishData) -> None:
+        response = requests.post(self.url, data=pdata.payload, timeout=self.timeout,
+                                 headers={"Content-Type": "application/json", "X-Topic": pdata.topic,
+                                          "X-Kind": pdata.message})
+        if response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code >= 400:
+            # the receiver does not want it, sending it again does not help
+            logger.warning("sink {} rejected '{}': {}".format(self.name, pdata.topic, response.status_code))
+
+    async def write(self, pdata: PublishData) -> None:
+        await asyncio.to_thread(self._post, pdata)
+
+
+class MqttSink(Sink):
+    """republishes the messages to a second broker, optionally under another topic prefix"""
+
+    def __init__(self, name: str, settings: dict):
+        super().__init__(name, settings)
+        self.settings = settings
+        self.prefix = settings.get('prefix', "")
+        self.client: Optional[aiomqtt.Client] = None
+
+    async def write(self, pdata: PublishData) -> None:
+        await self.client.publish(self.prefix + pdata.topic, pdata.payload, qos=pdata.qos, retain=pdata.retain)
+
+    async def run(self) -> None:
+        """deliver on one connection at a time, the pending message is sent again after a reconnect"""
+        while True:
+            try:
+                async with aiomqtt.Client(hostname=self.settings['host'], port=int(self.settings.get('port', 1883)),
+                                          username=self.settings.get('username'),
+                                          password=self.settings.get('password'), logger=logger) as client:
+                    self.client = client
+                    await super().run()
+            except aiomqtt.MqttError as mexc:
+                logger.error("sink {} mqtt error: {}".format(self.name, str(mexc)))
+            finally:
+                self.client = None
+            await asyncio.sleep(1)
+
+
+class Bus:
+    """
+    fans the published messages out to the configured sinks; every message is built and encoded once
+    by MqttClient.publish and shared by the broker queue and the sink queues
+    """
+
+    TYPES = {"file": FileSink, "webhook": WebhookSink, "mqtt": MqttSink}
+
+    def __init__(self):
+        self.sinks: list[Sink] = []
+
+    def setup(self, config: Config) -> None:
+        """create the sinks of the sinks option, invalid ones are skipped"""
+        self.sinks = []
+        for index, settings in enumerate(config['options'].get('sinks', [])):
+            name = settings.get('name') or "{}{}".format(settings.get('type', 'sink'), index)
+            try:
+                self.sinks.append(self.TYPES[settings['type']](name, settings))
+            except KeyError as ke:
+                logger.error("sink {} is not set up, {} is missing or unknown".format(name, str(ke)))
+        if self.sinks:
+            logger.info("{} sinks: {}".format(len(self.sinks), [sink.name for sink in self.sinks]))
+
+    def publish(self, pdata: PublishData) -> None:
+        """queue the message for every sink wanting it, never blocks"""
+        for sink in self.sinks:
+            if sink.wants(pdata):
+                sink.queue.put(pdata)
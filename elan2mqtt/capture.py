@@ -0,0 +1,76 @@
+import gzip
+import json
+import logging
+import threading
+import time
+from typing import Any
+from urllib.parse import urlsplit
+
+from config import Config
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Recorder:
+    """
+    writes the traffic of the bridge to a capture file, used by replay.py
+    one json line per record: [time, kind, key, data]
+    kinds: get (path, body), put (path, {data, result}), event (device id), command (topic, payload)
+    files ending with .gz are compressed
+    """
+
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def setup(self, config: Config) -> None:
+        """open the capture file if it is configured"""
+        filename = config['options'].get('capture_file')
+        if not filename or self.file is not None:
+            return
+        if filename.endswith(".gz"):
+            self.file = gzip.open(filename, "at", encoding="utf-8")
+        else:
+            self.file = open(filename, "a", encoding="utf-8")
+        logger.warning("traffic is captured to {}".format(filename))
+
+    def record(self, kind: str, key: str, data: Any = None) -> None:
+        """
+        append one record
+        :param kind: kind of the record
+        :param key: url or topic, urls are stored as path
+        :param data: body, payload or result
+        """
+        if self.file is None:
+            return
+        if key.startswith("http"):
+            key = urlsplit(key).path
+        line = json.dumps([round(time.time(), 4), kind, key, data], separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+recorder = Recorder()
+
+
+def load(filename: str) -> list:
+    """read all records of a capture file"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    records = []
+    with opener(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.error("invalid capture record skipped")
+    return records
@@ -1,9 +1,12 @@
 import json
 import logging
+import os
 logger = logging.getLogger(__name__)
 
 class Config:
     data = {}
+    filename: str = ""
+    mtime: float = 0
     def __init__(self, filename: str):
         """
         initialize config
@@ -13,6 +16,8 @@ class Config:
         logger.info("loading config file: '{}'".format(filename))
 
         try:
+            self.filename = filename
+            self.mtime = os.path.getmtime(filename)
             with open(filename, "r", encoding="utf8") as json_file:
                 self.data = json.load(json_file)
         except BaseException as be:
@@ -28,3 +33,20 @@ class Config:
 
     def __getitem__(self, item):
         return self.data[item]
+
+    def modified(self) -> bool:
+        """check if the file has been changed since it was loaded"""
+        try:
+            return os.path.getmtime(self.filename) != self.mtime
+        except OSError:
+            return False
+
+    def changes(self, other: "Config") -> set:
+        """names of the options and sections which differ in the other config"""
+        changed = {key for key in set(self.data) | set(other.data)
+                   if key != "options" and self.data.get(key) != other.data.get(key)}
+        options = self.data.get("options", {})
+        other_options = other.data.get("options", {})
+        changed |= {key for key in set(options) | set(other_options)
+                    if options.get(key) != other_options.get(key)}
+        return changed
@@ -1,8 +1,18 @@
+import metrics
+from config import Config
 from elan_client import ElanClient
-from mqtt_client import MqttClient
-
+from mqtt_client import MqttClient, AVAILABILITY
+from policy import Policy, Policies
+from scheduler import CommandScheduler
+from telemetry import Telemetry
+from validator import CommandValidator, CommandError
+
+import asyncio
+import hashlib
 import logging
 import json
+import time
+from typing import Optional
 
 
 logger: logging.Logger = logging.getLogger(__name__)
@@ -13,6 +23,41 @@ class Device:
     data: dict = {}
     elan: ElanClient = None
     mqtt: MqttClient = None
+    scheduler: Optional[CommandScheduler] = None
+    telemetry: Optional[Telemetry] = None
+    policies: Optional[Policies] = None
+    policy: Policy = Policy()
+    # time of the last polling sweep which included the device
+    polled: float = 0
+    state_raw: Optional[bytes] = None
+    state_hash: Optional[bytes] = None
+    # time of the last state change, catch-up sweeps publish the recently active devices first
+    last_active: float = 0
+    # time the cached state has been fetched
+    state_time: float = 0
+    fetching: Optional[asyncio.Task] = None
+    confirm_timeout: float = 3
+    command_retries: int = 1
+    # failed state requests in a row; after quarantine_after of them the device is offline and only probed
+    failures: int = 0
+    available: Optional[bool] = None
+    # monotonic time of the next probe of a quarantined device, 0 if the device is not quarantined
+    probe_at: float = 0
+    quarantine_after: int = 3
+    probe_interval: float = 60
+    probe_max: float = 3600
+    # attributes the state has to reach after the last command, set when reached, watcher of the command
+    awaiting: Optional[dict] = None
+    confirmed: Optional[asyncio.Event] = None
+    confirming: Optional[asyncio.Task] = None
+    attributes: dict = {}
+    attribute_topics: bool = False
+    validation: str = "off"
+    validator: Optional[CommandValidator] = None
+    kind: str = 'unknown'
+    listing: dict = {}
+    # digest of the device info returned by elan
+    fingerprint: str = ""
 
     def __getattr__(self, item: str):
         if item in self.data:
@@ -20,18 +65,85 @@ class Device:
         return None
 
     @classmethod
-    def init(cls, elan: ElanClient, mqtt: MqttClient):
+    def init(cls, elan: ElanClient, mqtt: MqttClient, config: Config = None,
+             scheduler: Optional[CommandScheduler] = None, telemetry: Optional[Telemetry] = None,
+             policies: Optional[Policies] = None):
         cls.elan = elan
         cls.mqtt = mqtt
+        cls.scheduler = scheduler
+        cls.telemetry = telemetry
+        cls.policies = policies
+        if config is not None:
+            cls.attribute_topics = bool(config['options'].get('attribute_topics', False))
+            cls.validation = config['options'].get('command_validation', 'off')
+            cls.confirm_timeout = float(config['options'].get('confirm_timeout', 3))
+            cls.command_retries = int(config['options'].get('command_retries', 1))
+            cls.quarantine_after = int(config['options'].get('quarantine_after', 3))
+            cls.probe_interval = float(config['options'].get('probe_interval', 60))
+            cls.probe_max = float(config['options'].get('probe_max', 3600))
+
+    def compile_validator(self):
+        """create the command validator of this device according to the validation mode"""
+        self.validator = None
+        # without actions info there is nothing to check against, the commands are passed
+        if self.validation in ("reject", "clamp") and self.data.get('actions info'):
+            self.validator = CommandValidator(
+                self.data.get('actions info', {}), self.data.get('primary actions', []), self.validation == "clamp")
+
+    def attribute_topic(self, attr: str) -> str:
+        """topic of a single state attribute"""
+        return self.data['status_topic'] + '/' + attr.replace(' ', '_')
+
+    def _state_source(self, attr: str, json_attributes: bool = False, **templates: str) -> dict:
+        """
+        state topic and templates of an entity showing one state attribute
+        :param attr: state attribute shown by the entity
+        :param json_attributes: show the whole status json as attributes of the entity; not with attribute
+                                topics, home assistant would parse the status for every entity on each update
+        :param templates: templates reading the attribute from the status json
+        :return: discovery items, pointing to the attribute topic if enabled
+        """
+        if not self.attribute_topics:
+            result = {'state_topic': self.data['status_topic'], **templates}
+            if json_attributes:
+                result['json_attributes_topic'] = self.data['status_topic']
+            return result
+        result = {'state_topic': self.attribute_topic(attr)}
+        for key, template in templates.items():
+            result[key] = template.replace(
+                'value_json.' + attr, 'value_json').replace(
+                'value_json["' + attr + '"]', 'value_json')
+        return result
+
+    @staticmethod
+    def _topics(prefix: str, mac: str) -> dict:
+        """topics of a device"""
+        return {
+            "status_topic": prefix + '/' + mac + '/status',
+            "control_topic": prefix + '/' + mac + '/command',
+            "error_topic": prefix + '/' + mac + '/error',
+            "availability_topic": prefix + '/' + mac + '/availability',
+        }
+
+    def _availability(self) -> dict:
+        """discovery items making the entity unavailable while the gateway or the device is offline"""
+        return {'availability': [{'topic': AVAILABILITY}, {'topic': self.data['availability_topic']}],
+                'availability_mode': 'all'}
 
     def set_discovery(self, type, *args):
         getattr(self, f"_discovery_{type}")()
 
+    @staticmethod
+    def info_fingerprint(info: dict) -> str:
+        """digest of the device info as returned by elan, changes with the label, type or actions"""
+        return hashlib.blake2b(json.dumps(info, sort_keys=True).encode(), digest_size=16).hexdigest()
+
     @classmethod
     def create(cls, url: str):
         self = cls()
         try:
             info = self.elan.get(url)
+            self.fingerprint = self.info_fingerprint(info)
 
             if "address" in info['device info']:
                 mac = str(info['device info']['address'])
@@ -41,12 +153,12 @@ class Device:
                 info['device info']['address'] = mac
 
             logger.info("Setting up " + url)
+            self.attributes = {}
             # print("Setting up ", device_list[device]['url'], device_list[device])
 
             info['mac'] = mac
             info['url'] = url
-            info["status_topic"] = 'eLan/' + mac + '/status'
-            info["control_topic"] = 'eLan/' + mac + '/command'
+            info.update(self._topics('eLan', mac))
 
             if "product type" in info['device info']:
                 # placeholder for device type versus product type check
@@ -59,6 +171,7 @@ class Device:
             logger.error(be, exc_info=True)
             raise
         self.data = info
+        self.compile_validator()
 
         d_type = self.data['device info']['type']
         d_product = self.data['device info']['product type']
@@ -101,6 +214,11 @@ class Device:
             kind = "alarm"
         logger.debug("device type: '{}', product type: '{}', kind: '{}'".format(d_type, d_product, kind))
 
+        self.kind = kind
+        if self.policies is not None:
+            self.policy = self.policies.resolve(self)
+            if self.policy.topic_prefix != 'eLan':
+                self.data.update(self._topics(self.policy.topic_prefix, self.mac))
         self.set_discovery(kind)
 
         return self
@@ -113,6 +231,7 @@ class Device:
                 "schema": "basic",
                 "name": self.data["device info"]["label"],
                 "unique_id": ("eLan-" + self.data["mac"]),
+                **self._availability(),
                 "device": {
                     "name": self.data["device info"]["label"],
                     "identifiers": ("eLan-light-" + self.data["mac"]),
@@ -121,11 +240,12 @@ class Device:
                     "mdl": self.data["device info"]["product type"],
                 },
                 "command_topic": self.data["control_topic"],
-                "state_topic": self.data["status_topic"],
-                "json_attributes_topic": self.data["status_topic"],
+                "optimistic": self.policy.optimistic,
                 "payload_off": '{"on":false}',
                 "payload_on": '{"on":true}',
-                "state_value_template": '{%- if value_json.on -%}{"on":true}{%- else -%}{"on":false}{%- endif -%}',
+                **self._state_source(
+                    "on", json_attributes=True,
+                    state_value_template='{%- if value_json.on -%}{"on":true}{%- else -%}{"on":false}{%- endif -%}'),
             }
             ddd["homeassistant/light/" + self.data["mac"] + "/config"] = json.dumps(discovery)
             self.data["discovery"] = ddd
@@ -137,6 +257,7 @@ class Device:
                 'schema': 'template',
                 'name': self.data['device info']['label'],
                 'unique_id': ('eLan-' + self.data['mac']),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-dimmer-' + self.data['mac']),
@@ -144,21 +265,23 @@ class Device:
                     'mf': 'Elko EP',
                     'mdl': self.data['device info']['product type']
                 },
-                'state_topic': self.data['status_topic'],
                 # 'json_attributes_topic': self.data['status_topic'],
                 'command_topic': self.data['control_topic'],
+                'optimistic': self.policy.optimistic,
                 'command_on_template':
                     '{%- if brightness is defined -%} {"brightness": {{ (brightness * '
                     + str(self.data['actions info']['brightness']
                           ['max']) +
                     ' / 255 ) | int }} } {%- else -%} {"brightness": 100 } {%- endif -%}',
                 'command_off_template': '{"brightness": 0 }',
-                'state_template':
-                    '{%- if value_json.brightness > 0 -%}on{%- else -%}off{%- endif -%}',
-                'brightness_template':
-                    '{{ (value_json.brightness * 255 / ' + str(
-                        self.data['actions info']['brightness']
-                        ['max']) + ') | int }}'
+                **self._state_source(
+                    'brightness',
+                    state_template=
+                        '{%- if value_json.brightness > 0 -%}on{%- else -%}off{%- endif -%}',
+                    brightness_template=
+                        '{{ (value_json.brightness * 255 / ' + str(
+                            self.data['actions info']['brightness']
+                            ['max']) + ') | int }}')
             }
             ddd['homeassistant/light/' + self.data['mac'] + '/config'] = json.dumps(discovery)
             self.data['discovery'] = ddd
@@ -173,6 +296,7 @@ class Device:
                 'schema': 'basic',
                 'name': self.data['device info']['label'],
                 'unique_id': ('eLan-' + self.data['mac']),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-switch-' + self.data['mac']),
@@ -181,14 +305,13 @@ class Device:
                     'mdl': self.data['device info']['product type']
                 },
                 'command_topic': self.data['control_topic'],
-                'state_topic': self.data['status_topic'],
-                'json_attributes_topic': self.data['status_topic'],
+                'optimistic': self.policy.optimistic,
                 'payload_off': '{"on":false}',
                 'payload_on': '{"on":true}',
                 'state_off': 'off',
                 'state_on': 'on',
-                'value_template':
-                    '{%- if value_json.on -%}on{%- else -%}off{%- endif -%}'
+                **self._state_source(
+                    'on', json_attributes=True, value_template='{%- if value_json.on -%}on{%- else -%}off{%- endif -%}')
             }
             ddd['homeassistant/switch/' + self.data['mac'] + '/config'] = json.dumps(discovery)
             self.data['discovery'] = ddd
@@ -200,6 +323,7 @@ class Device:
         discovery = {
             "name": self.data["device info"]["label"] + "-IN",
             "unique_id": ("eLan-" + self.data["mac"] + "-IN"),
+            **self._availability(),
             "device": {
                 "name": self.data["device info"]["label"],
                 "identifiers": ("eLan-thermostat-" + self.data["mac"]),
@@ -208,9 +332,8 @@ class Device:
                 "mdl": self.data["device info"]["product type"],
             },
             "device_class": "temperature",
-            "state_topic": self.data["status_topic"],
-            "json_attributes_topic": self.data["status_topic"],
-            "value_template": '{{ value_json["temperature IN"] }}',
+            **self._state_source("temperature IN", json_attributes=True,
+                value_template='{{ value_json["temperature IN"] }}'),
             "unit_of_measurement": "°C",
         }
         ddd["homeassistant/sensor/" + self.data["mac"] + "/IN/config"] = json.dumps(discovery)
@@ -218,6 +341,7 @@ class Device:
         discovery = {
             "name": self.data["device info"]["label"] + "-OUT",
             "unique_id": ("eLan-" + self.data["mac"] + "-OUT"),
+            **self._availability(),
             "device": {
                 "name": self.data["device info"]["label"],
                 "identifiers": ("eLan-thermostat-" + self.data["mac"]),
@@ -225,10 +349,9 @@ class Device:
                 "mf": "Elko EP",
                 "mdl": self.data["device info"]["product type"],
             },
-            "state_topic": self.data["status_topic"],
-            "json_attributes_topic": self.data["status_topic"],
             "device_class": "temperature",
-            "value_template": '{{ value_json["temperature OUT"] }}',
+            **self._state_source("temperature OUT", json_attributes=True,
+                value_template='{{ value_json["temperature OUT"] }}'),
             "unit_of_measurement": "°C",
         }
         ddd["homeassistant/sensor/" + self.data["mac"] + "/OUT/config"] = json.dumps(discovery)
@@ -247,6 +370,7 @@ class Device:
         discovery = {
             'name': self.data['device info']['label'] + '-IN',
             'unique_id': ('eLan-' + self.data['mac'] + '-IN'),
+            **self._availability(),
             'device': {
                 'name': self.data['device info']['label'],
                 'identifiers': ('eLan-thermometer-' + self.data['mac']),
@@ -255,9 +379,8 @@ class Device:
                 'mdl': self.data['device info']['product type']
             },
             'device_class': 'temperature',
-            'state_topic': self.data['status_topic'],
-            'json_attributes_topic': self.data['status_topic'],
-            'value_template': '{{ value_json["temperature IN"] }}',
+            **self._state_source('temperature IN', json_attributes=True,
+                value_template='{{ value_json["temperature IN"] }}'),
             'unit_of_measurement': '°C'
         }
         ddd['homeassistant/sensor/' + self.data['mac'] + '/IN/config'] = json.dumps(discovery)
@@ -265,6 +388,7 @@ class Device:
         discovery = {
             'name': self.data['device info']['label'] + '-OUT',
             'unique_id': ('eLan-' + self.data['mac'] + '-OUT'),
+            **self._availability(),
             'device': {
                 'name': self.data['device info']['label'],
                 'identifiers': ('eLan-thermometer-' + self.data['mac']),
@@ -272,10 +396,9 @@ class Device:
                 'mf': 'Elko EP',
                 'mdl': self.data['device info']['product type']
             },
-            'state_topic': self.data['status_topic'],
-            'json_attributes_topic': self.data['status_topic'],
             'device_class': 'temperature',
-            'value_template': '{{ value_json["temperature OUT"] }}',
+            **self._state_source('temperature OUT', json_attributes=True,
+                value_template='{{ value_json["temperature OUT"] }}'),
             'unit_of_measurement': '°C'
         }
         ddd['homeassistant/sensor/' + self.data['mac'] + '/OUT/config'] = json.dumps(discovery)
@@ -318,6 +441,7 @@ class Device:
         discovery = {
             'name': self.data['device info']['label'],
             'unique_id': ('eLan-' + self.data['mac']),
+            **self._availability(),
             'device': {
                 'name': self.data['device info']['label'],
                 'identifiers': ('eLan-detector-' + self.data['mac']),
@@ -325,11 +449,10 @@ class Device:
                 'mf': 'Elko EP',
                 'mdl': self.data['device info']['product type']
             },
-            'state_topic': self.data['status_topic'],
-            'json_attributes_topic': self.data['status_topic'],
             #                    'device_class': 'heat',
-            'value_template':
-                '{%- if value_json.detect -%}on{%- else -%}off{%- endif -%}'
+            **self._state_source(
+                'detect', json_attributes=True,
+                value_template='{%- if value_json.detect -%}on{%- else -%}off{%- endif -%}'),
             #                    'command_topic': self.data['control_topic']
         }
 
@@ -343,6 +466,7 @@ class Device:
         discovery = {
             'name': self.data['device info']['label'] + 'battery',
             'unique_id': ('eLan-' + self.data['mac'] + '-battery'),
+            **self._availability(),
             'device': {
                 'name': self.data['device info']['label'],
                 'identifiers': ('eLan-detector-' + self.data['mac']),
@@ -351,10 +475,9 @@ class Device:
                 'mdl': self.data['device info']['product type']
             },
             'device_class': 'battery',
-            'state_topic': self.data['status_topic'],
             # 'json_attributes_topic': self.data['status_topic'],
-            'value_template':
-                '{%- if value_json.battery -%}100{%- else -%}0{%- endif -%}'
+            **self._state_source(
+                'battery', value_template='{%- if value_json.battery -%}100{%- else -%}0{%- endif -%}'),
             #                    'command_topic': self.data['control_topic']
         }
         ddd['homeassistant/sensor/' + self.data['mac'] + '/battery/config'] = json.dumps(discovery)
@@ -373,6 +496,7 @@ class Device:
         discovery = {
             'name': self.data['device info']['label'] + 'alarm',
             'unique_id': ('eLan-' + self.data['mac'] + '-alarm'),
+            **self._availability(),
             'icon': 'mdi:alarm-light',
             'device': {
                 'name': self.data['device info']['label'],
@@ -381,10 +505,9 @@ class Device:
                 'mf': 'Elko EP',
                 'mdl': self.data['device info']['product type']
             },
-            'state_topic': self.data['status_topic'],
-            'json_attributes_topic': self.data['status_topic'],
-            'value_template':
-                '{%- if value_json.alarm -%}on{%- else -%}off{%- endif -%}'
+            **self._state_source(
+                'alarm', json_attributes=True,
+                value_template='{%- if value_json.alarm -%}on{%- else -%}off{%- endif -%}'),
             #                    'command_topic': self.data['control_topic']
         }
         ddd['homeassistant/sensor/' + self.data['mac'] + '/alarm/config'] = json.dumps(discovery)
@@ -397,6 +520,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + 'tamper',
                 'unique_id': ('eLan-' + self.data['mac'] + '-tamper'),
+                **self._availability(),
                 'icon': 'mdi:gesture-tap',
                 'device': {
                     'name': self.data['device info']['label'],
@@ -405,10 +529,9 @@ class Device:
                     'mf': 'Elko EP',
                     'mdl': self.data['device info']['product type']
                 },
-                'state_topic': self.data['status_topic'],
-                'json_attributes_topic': self.data['status_topic'],
-                'value_template':
-                    '{%- if value_json.tamper == "opened" -%}on{%- else -%}off{%- endif -%}'
+                **self._state_source(
+                    'tamper', json_attributes=True,
+                    value_template='{%- if value_json.tamper == "opened" -%}on{%- else -%}off{%- endif -%}'),
                 #                    'command_topic': self.data['control_topic']
             }
 
@@ -418,6 +541,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + 'automat',
                 'unique_id': ('eLan-' + self.data['mac'] + '-automat'),
+                **self._availability(),
                 'icon': 'mdi:arrow-decision-auto',
                 'device': {
                     'name': self.data['device info']['label'],
@@ -426,10 +550,9 @@ class Device:
                     'mf': 'Elko EP',
                     'mdl': self.data['device info']['product type']
                 },
-                'state_topic': self.data['status_topic'],
-                'json_attributes_topic': self.data['status_topic'],
-                'value_template':
-                    '{%- if value_json.automat -%}on{%- else -%}off{%- endif -%}'
+                **self._state_source(
+                    'automat', json_attributes=True,
+                    value_template='{%- if value_json.automat -%}on{%- else -%}off{%- endif -%}'),
                 #                    'command_topic': self.data['control_topic']
             }
             ddd['homeassistant/sensor/' + self.data['mac'] + '/automat/config'] = json.dumps(discovery)
@@ -438,6 +561,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + 'disarm',
                 'unique_id': ('eLan-' + self.data['mac'] + '-disarm'),
+                **self._availability(),
                 'icon': 'mdi:lock-alert',
                 'device': {
                     'name': self.data['device info']['label'],
@@ -446,10 +570,9 @@ class Device:
                     'mf': 'Elko EP',
                     'mdl': self.data['device info']['product type']
                 },
-                'state_topic': self.data['status_topic'],
-                'json_attributes_topic': self.data['status_topic'],
-                'value_template':
-                    '{%- if value_json.disarm -%}on{%- else -%}off{%- endif -%}'
+                **self._state_source(
+                    'disarm', json_attributes=True,
+                    value_template='{%- if value_json.disarm -%}on{%- else -%}off{%- endif -%}'),
                 #                    'command_topic': self.data['control_topic']
             }
             ddd['homeassistant/sensor/' + self.data['mac'] + '/disarm/config'] = json.dumps(discovery)
@@ -463,6 +586,7 @@ class Device:
         discovery = {
             "name": self.data["device info"]["label"] + "regulator",
             "unique_id": ("eLan-" + self.data["mac"] + "-regulator"),
+            **self._availability(),
             "icon": "mdi:lock-alert",
             "device": {
                 "name": self.data["device info"]["label"],
@@ -472,9 +596,7 @@ class Device:
                 "mdl": self.data["device info"]["product type"],
             },
             "device_class": "temperature",
-            "state_topic": self.data["status_topic"],
-            "json_attributes_topic": self.data["status_topic"],
-            "value_template": '{{ value_json["temperature"] }}',
+            **self._state_source("temperature", json_attributes=True, value_template='{{ value_json["temperature"] }}'),
             "unit_of_measurement": "°C"
         }
         ddd["homeassistant/sensor/" + self.data["mac"] + "/regulator/config"] = json.dumps(discovery)
@@ -494,6 +616,7 @@ class Device:
                     'schema': 'basic',
                     'name': self.data['device info']['label'],
                     'unique_id': ('eLan-' + self.data['mac']),
+                    **self._availability(),
                     'device': {
                         'name': self.data['device info']['label'],
                         'identifiers': ('eLan-light-' + self.data['mac']),
@@ -502,6 +625,7 @@ class Device:
                         'mdl': self.data['device info']['product type']
                     },
                     'command_topic': self.data['control_topic'],
+                    'optimistic': self.policy.optimistic,
                     'state_topic': self.data['status_topic'],
                     'json_attributes_topic': self.data['status_topic'],
                     'payload_off': '{"on":false}',
@@ -520,6 +644,7 @@ class Device:
                     'schema': 'template',
                     'name': self.data['device info']['label'],
                     'unique_id': ('eLan-' + self.data['mac']),
+                    **self._availability(),
                     'device': {
                         'name': self.data['device info']['label'],
                         'identifiers': ('eLan-dimmer-' + self.data['mac']),
@@ -530,6 +655,7 @@ class Device:
                     'state_topic': self.data['status_topic'],
                     # 'json_attributes_topic': self.data['status_topic'],
                     'command_topic': self.data['control_topic'],
+                    'optimistic': self.policy.optimistic,
                     'command_on_template':
                         '{%- if brightness is defined -%} {"brightness": {{ (brightness * '
                         + str(self.data['actions info']['brightness']
@@ -566,6 +692,7 @@ class Device:
                     'schema': 'basic',
                     'name': self.data['device info']['label'],
                     'unique_id': ('eLan-' + self.data['mac']),
+                    **self._availability(),
                     'device': {
                         'name': self.data['device info']['label'],
                         'identifiers': ('eLan-switch-' + self.data['mac']),
@@ -574,6 +701,7 @@ class Device:
                         'mdl': self.data['device info']['product type']
                     },
                     'command_topic': self.data['control_topic'],
+                    'optimistic': self.policy.optimistic,
                     'state_topic': self.data['status_topic'],
                     'json_attributes_topic': self.data['status_topic'],
                     'payload_off': '{"on":false}',
@@ -600,6 +728,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + '-IN',
                 'unique_id': ('eLan-' + self.data['mac'] + '-IN'),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-thermostat-' + self.data['mac']),
@@ -618,6 +747,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + '-OUT',
                 'unique_id': ('eLan-' + self.data['mac'] + '-OUT'),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-thermostat-' + self.data['mac']),
@@ -647,6 +777,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + '-IN',
                 'unique_id': ('eLan-' + self.data['mac'] + '-IN'),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-thermometer-' + self.data['mac']),
@@ -665,6 +796,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + '-OUT',
                 'unique_id': ('eLan-' + self.data['mac'] + '-OUT'),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-thermometer-' + self.data['mac']),
@@ -722,6 +854,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'],
                 'unique_id': ('eLan-' + self.data['mac']),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-detector-' + self.data['mac']),
@@ -747,6 +880,7 @@ class Device:
             discovery = {
                 'name': self.data['device info']['label'] + 'battery',
                 'unique_id': ('eLan-' + self.data['mac'] + '-battery'),
+                **self._availability(),
                 'device': {
                     'name': self.data['device info']['label'],
                     'identifiers': ('eLan-detector-' + self.data['mac']),
@@ -775,6 +909,7 @@ class Device:
                 discovery = {
                     'name': self.data['device info']['label'] + 'alarm',
                     'unique_id': ('eLan-' + self.data['mac'] + '-alarm'),
+                    **self._availability(),
                     'icon': 'mdi:alarm-light',
                     'device': {
                         'name': self.data['device info']['label'],
@@ -799,6 +934,7 @@ class Device:
                 discovery = {
                     'name': self.data['device info']['label'] + 'tamper',
                     'unique_id': ('eLan-' + self.data['mac'] + '-tamper'),
+                    **self._availability(),
                     'icon': 'mdi:gesture-tap',
                     'device': {
                         'name': self.data['device info']['label'],
@@ -820,6 +956,7 @@ class Device:
                 discovery = {
                     'name': self.data['device info']['label'] + 'automat',
                     'unique_id': ('eLan-' + self.data['mac'] + '-automat'),
+                    **self._availability(),
                     'icon': 'mdi:arrow-decision-auto',
                     'device': {
                         'name': self.data['device info']['label'],
@@ -840,6 +977,7 @@ class Device:
                 discovery = {
                     'name': self.data['device info']['label'] + 'disarm',
                     'unique_id': ('eLan-' + self.data['mac'] + '-disarm'),
+                    **self._availability(),
                     'icon': 'mdi:lock-alert',
                     'device': {
                         'name': self.data['device info']['label'],
@@ -857,38 +995,244 @@ class Device:
                 ddd['homeassistant/sensor/' + self.data['mac'] + '/disarm/config'] = json.dumps(discovery)
                 self.data['discovery'] = ddd
 
-    def publish(self):
-        """publish device state to mqtt"""
+    def publish(self) -> bool:
+        """
+        publish device state to mqtt
+        the state body of eLan is forwarded without parsing, changes are detected by its hash
+        :return: true: state differs from the previously published one
+        """
         try:
-            resp = self.elan.get(self.url + '/state')
-            self.mqtt.publish(self.status_topic, json.dumps(resp), "status")
-            logger.info("{} has been published".format(self.url))
+            return self.publish_state(self.elan.get_raw(self.url + '/state'))
         except BaseException as be:
             logger.error("publishing of {} failed {}".format(self.url, str(be)))
+        return False
+
+    def cache_state(self, raw: bytes) -> bool:
+        """
+        keep the state without publishing it
+        :param raw: state body returned by eLan
+        :return: true: state differs from the kept one
+        """
+        digest = hashlib.blake2b(raw, digest_size=16).digest()
+        changed = digest != self.state_hash
+        self.state_raw = raw
+        self.state_hash = digest
+        self.state_time = time.time()
+        if changed:
+            self.last_active = self.state_time
+        return changed
+
+    def publish_state(self, raw: Optional[bytes]) -> bool:
+        """
+        publish an already fetched device state to mqtt
+        :param raw: state body returned by eLan
+        :return: true: state differs from the previously published one
+        """
+        self.set_available(raw is not None)
+        if raw is None:
+            return False
+        changed = self.cache_state(raw)
+        self.mqtt.publish(self.status_topic, raw, "status", retain=self.policy.retain, qos=self.policy.qos)
+        record = self.telemetry is not None and self.telemetry.wants(self.kind)
+        if record or self.awaiting is not None or (changed and self.attribute_topics):
+            state = json.loads(raw)
+            if self.awaiting is not None and self._reached(state):
+                self.confirmed.set()
+            if record:
+                self.telemetry.record(self.mac, state)
+            if changed and self.attribute_topics:
+                self.publish_attributes(state)
+        logger.info("{} has been published".format(self.url))
+        return changed
+
+    def due(self) -> bool:
+        """false while the device is quarantined and its next probe is not due yet"""
+        return not self.probe_at or time.monotonic() >= self.probe_at
+
+    def set_available(self, reachable: bool):
+        """
+        track the state requests; after quarantine_after failures in a row the device is published offline
+        and quarantined, polling sweeps probe it in intervals doubling from probe_interval up to probe_max
+        :param reachable: true: elan has answered the state request
+        """
+        if reachable:
+            if self.probe_at:
+                logger.warning("{} is reachable again".format(self.url))
+            self.failures = 0
+            self.probe_at = 0
+        else:
+            self.failures += 1
+            if self.failures < self.quarantine_after:
+                logger.error("state of {} is not available".format(self.url))
+                return
+            delay = min(self.probe_max, self.probe_interval * 2 ** min(self.failures - self.quarantine_after, 16))
+            if not self.probe_at:
+                logger.error("{} is quarantined after {} failures".format(self.url, self.failures))
+            logger.info("{} is probed again in {} secs".format(self.url, round(delay)))
+            self.probe_at = time.monotonic() + delay
+        if self.available != reachable:
+            self.available = reachable
+            self.mqtt.publish(self.availability_topic, "online" if reachable else "offline", "availability",
+                              retain=True)
+
+    async def refresh(self) -> Optional[bytes]:
+        """
+        fetch and publish the state without blocking the loop; concurrent callers share one request to elan
+        :return: the fetched state, None if it is not available
+        """
+        if self.fetching is None or self.fetching.done():
+            self.fetching = asyncio.create_task(self._fetch())
+        return await asyncio.shield(self.fetching)
+
+    async def _fetch(self) -> Optional[bytes]:
+        raw = await asyncio.to_thread(self.elan.get_raw, self.url + '/state')
+        self.publish_state(raw)
+        return raw
+
+    def republish(self):
+        """publish the last known state again, without asking elan"""
+        if self.state_raw is not None:
+            self.mqtt.publish(self.status_topic, self.state_raw, "status", retain=self.policy.retain,
+                              qos=self.policy.qos)
+
+    def publish_attributes(self, state: dict):
+        """
+        publish the changed state attributes to their own topics
+        :param state: parsed device state
+        """
+        for attr, value in state.items():
+            payload = json.dumps(value)
+            if self.attributes.get(attr) == payload:
+                continue
+            self.attributes[attr] = payload
+            self.mqtt.publish(self.attribute_topic(attr), payload, "attribute", retain=True, qos=self.policy.qos)
+
+    def undiscover(self):
+        """remove the device from home assistant by empty retained discovery messages"""
+        for topic in (self.discovery or {}):
+            self.mqtt.publish(topic, "", "discovery", retain=True)
+        self.mqtt.publish(self.availability_topic, "", "availability", retain=True)
+        logger.info("{} has been removed from discovery".format(self.url))
 
     async def discover(self):
         """publish device discovery info to mqtt"""
         if "discovery" not in self.data:
             logger.warning("no discovery data for {} available".format(self.data['url']))
             return
+        if not self.policy.discovery:
+            return
         for topic, data in self.discovery.items():
             self.mqtt.publish(topic, data, "discovery")
         logger.info("{} has been set to discovered".format(self.url))
 
+    async def send_command(self, data: str) -> bool:
+        """
+        validate the command and send it to elan
+        :param data: command payload
+        :return: true: command has been accepted by elan
+        """
+        logger.debug("processing: {}, {}".format(self.url, data))
+        received = time.monotonic()
+        if self.validator is not None:
+            try:
+                data = self.validator.validate(data)
+            except CommandError as ce:
+                logger.warning("command for {} rejected: {}".format(self.url, str(ce)))
+                self.mqtt.publish(self.error_topic, json.dumps({"command": data, "error": str(ce)}), "error")
+                return False
+        await self._put(data)
+        if not self.policy.optimistic:
+            self.track(data, received)
+        return True
+
+    async def _put(self, data: str):
+        """send the command to elan, paced by the scheduler"""
+        if self.scheduler is not None:
+            command_info: str = await self.scheduler.submit(self.mac, self.elan.put, self.url, data)
+        else:
+            command_info: str = await asyncio.to_thread(self.elan.put, self.url, data=data)
+        logger.debug(command_info)
+
+    def _expected(self, data: str) -> dict:
+        """attributes of the command the state can show, empty if the command cannot be confirmed"""
+        if self.state_raw is None:
+            return {}
+        try:
+            command = json.loads(data)
+            state = json.loads(self.state_raw)
+        except ValueError:
+            return {}
+        if not isinstance(command, dict) or not isinstance(state, dict):
+            return {}
+        return {key: value for key, value in command.items()
+                if key in state and isinstance(value, (bool, int, float, str))}
+
+    def _reached(self, state: dict) -> bool:
+        """true if the state shows all attributes of the last command"""
+        return all(state.get(key) == value for key, value in self.awaiting.items())
+
+    def track(self, data: str, received: float):
+        """
+        watch the state until it shows the command, a newer command replaces the watched one
+        :param data: command sent to elan
+        :param received: monotonic time the command has been received
+        """
+        expected = self._expected(data)
+        if not expected:
+            return
+        if self.confirming is not None and not self.confirming.done():
+            self.confirming.cancel()
+        self.awaiting = expected
+        self.confirmed = asyncio.Event()
+        self.confirming = asyncio.create_task(self._confirm(data, received), name="confirm-{}".format(self.mac))
+
+    async def _confirm(self, data: str, received: float):
+        """
+        wait for the state of the command from the websocket or a poll; if it does not come in confirm_timeout
+        the state is read again and the command is sent again, up to command_retries times
+        """
+        attempts = 0
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.confirmed.wait(), self.confirm_timeout)
+                    latency = time.monotonic() - received
+                    metrics.metric("command_confirm").add(latency)
+                    metrics.histogram("confirm_latency/{}".format(self.mac)).add(latency)
+                    return
+                except TimeoutError:
+                    pass
+                # the state may have changed without an event
+                await self.refresh()
+                if self.confirmed.is_set():
+                    continue
+                if attempts >= self.command_retries:
+                    logger.warning("command for {} has not been confirmed: {}".format(self.url, data))
+                    metrics.metric("command_unconfirmed").add(attempts + 1)
+                    self.mqtt.publish(self.error_topic, json.dumps(
+                        {"command": data, "error": "not confirmed after {} attempts".format(attempts + 1)}), "error")
+                    return
+                attempts += 1
+                logger.warning("command for {} has not been confirmed, retry {}".format(self.url, attempts))
+                await self._put(data)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as be:
+            logger.error("confirmation of {} failed {}".format(self.url, str(be)))
+        finally:
+            if self.confirming is asyncio.current_task():
+                self.awaiting = None
+
     async def process_command(self, data: str):
         """send command to elan and mqtt"""
         # print("Got message:", topic, data)
         try:
-
-            # post command to device - warning there are no checks
-            logger.debug("processing: {}, {}".format(self.url, data))
-            # data = json.loads(data)
-            #resp: Response = elan_cli.put(d[tmp[1]]['url'], data=data)
-            #command_info = resp.text
-            command_info: str = self.elan.put(self.url, data=data)
-            # print(resp)
-            logger.debug(command_info)
-            # check and publish updated state of device
-            self.publish()
+            if not await self.send_command(data):
+                return
+            # check and publish updated state of device, optimistic devices wait for the websocket or polling
+            if not self.policy.optimistic:
+                await self.refresh()
+        except asyncio.CancelledError:
+            raise
         except BaseException as be:
             logger.error("publishing of {} failed {}".format(self.url, str(be)))
@@ -0,0 +1,121 @@
+import asyncio
+import gc
+import json
+import logging
+import os
+import time
+import tracemalloc
+from collections.abc import Callable
+from typing import Optional
+
+from config import Config
+from mqtt_client import MqttClient
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class MemoryDiagnostics:
+    """
+    periodic tracemalloc snapshots: the allocation sites growing most since the previous snapshot,
+    the memory of the process and the size of the subsystems are published to mqtt or appended to a file
+    """
+
+    TOPIC = "eLan/bridge/memory"
+
+    def __init__(self, mqtt: MqttClient):
+        """
+        init diagnostics
+        :param mqtt: client to publish the reports
+        """
+        self.mqtt = mqtt
+        self.interval = 0.0
+        self.filename = ""
+        self.top = 15
+        self.frames = 1
+        # size of each subsystem (devices, queue, ...), registered by the gateway
+        self.gauges: dict[str, Callable[[], int]] = {}
+        self.previous: Optional[tracemalloc.Snapshot] = None
+
+    def setup(self, config: Config) -> None:
+        """configure diagnostics, memory_diagnostics is the interval in seconds, 0 disables it"""
+        options = config['options']
+        self.interval = float(options.get('memory_diagnostics', 0))
+        self.filename = options.get('memory_diagnostics_file', "")
+        self.top = int(options.get('memory_top', 15))
+        self.frames = int(options.get('memory_frames', 1))
+
+    @staticmethod
+    def _rss_kb() -> int:
+        """resident memory of the process, 0 if unknown"""
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def _snapshot(self) -> tuple[tracemalloc.Snapshot, list[tracemalloc.StatisticDiff]]:
+        """take a snapshot and compare it to the previous one, runs in a thread"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        key = "traceback" if self.frames > 1 else "lineno"
+        diff = snapshot.compare_to(self.previous, key) if self.previous is not None else []
+        return snapshot, diff
+
+    def report(self, diff: list[tracemalloc.StatisticDiff]) -> dict:
+        """
+        memory report
+        :param diff: statistics compared to the previous snapshot
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        gauges = {}
+        for name, gauge in self.gauges.items():
+            try:
+                gauges[name] = gauge()
+            except BaseException as be:
+                gauges[name] = str(be)
+        growing = sorted((s for s in diff if s.size_diff > 0), key=lambda s: s.size_diff, reverse=True)
+        return {
+            "time": round(time.time(), 3),
+            "rss_kb": self._rss_kb(),
+            "traced_kb": current // 1024,
+            "peak_kb": peak // 1024,
+            "gc_objects": len(gc.get_objects()),
+            "subsystems": gauges,
+            "top": [{
+                "where": [str(frame) for frame in stat.traceback],
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "size_kb": round(stat.size / 1024, 1),
+                "count_diff": stat.count_diff,
+            } for stat in growing[:self.top]],
+        }
+
+    def _append(self, payload: str) -> None:
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write(payload + "\n")
+
+    async def run(self) -> None:
+        """take snapshots in loop, the first one is the baseline"""
+        if not self.interval:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        logger.warning("memory diagnostics are enabled, every {} secs".format(self.interval))
+        try:
+            self.previous, _ = await asyncio.to_thread(self._snapshot)
+            while True:
+                await asyncio.sleep(self.interval)
+                started = time.monotonic()
+                snapshot, diff = await asyncio.to_thread(self._snapshot)
+                self.previous = snapshot
+                report = self.report(diff)
+                report["snapshot_time"] = round(time.monotonic() - started, 3)
+                if self.filename:
+                    await asyncio.to_thread(self._append, json.dumps(report))
+                else:
+                    self.mqtt.publish(self.TOPIC, json.dumps(report), "metrics")
+        finally:
+            self.previous = None
+            tracemalloc.stop()
@@ -1,18 +1,34 @@
 import argparse
 import asyncio
+import collections
+import functools
 import logging
-import threading
-from typing import List
+import os
+from typing import List, Optional
 import time
 import sys
 
+import json
+
 import elan_client
+from capture import recorder
+import metrics
+from bus import Bus
 import mqtt_client
 from config import Config
-from elan_logger import set_logger
+from elan_logger import set_logger, set_log_level
+from scheduler import CommandScheduler
 
 from device import Device
-from asyncio import TaskGroup
+from diagnostics import MemoryDiagnostics
+from groups import Group, build_groups
+from health import Health
+from lease import Lease
+from monitor import LoopMonitor
+from policy import Policies
+from router import Handler, Reply, RequestHandler, Router, alias
+from supervisor import Supervisor
+from telemetry import Telemetry
 
 logger = logging.getLogger(__name__)
 
@@ -20,10 +36,27 @@ config_data: Config
 
 elan: elan_client.ElanClient = elan_client.ElanClient()
 mqtt: mqtt_client.MqttClient = mqtt_client.MqttClient("main")
+scheduler: CommandScheduler = CommandScheduler()
+health: Health = Health(elan, mqtt)
+monitor: LoopMonitor = LoopMonitor()
+telemetry: Telemetry = Telemetry()
+router: Router = Router()
+lease: Lease = Lease(mqtt)
+diagnostics: MemoryDiagnostics = MemoryDiagnostics(mqtt)
+policies: Policies = Policies()
+bus: Bus = Bus()
+
+# tasks run by the leader only, a standby keeps the devices and their states
+LEADER_TASKS = ["publish", "discover", "websocket", "subscribe"]
 
 devices: List[Device] = []
 device_hash: dict[str, Device] = {}
 device_addr_hash: dict[str, Device] = {}
+device_listing: dict[str, Device] = {}
+# list entries of the devices left out by device_include/device_exclude
+excluded: dict[str, dict] = {}
+groups: dict[str, Group] = {}
+replay_task: Optional[asyncio.Task] = None
 
 
 def read_config() -> Config:
@@ -41,39 +74,213 @@ def read_config() -> Config:
         raise
 
 
+def _add_device(dev: Device):
+    devices.append(dev)
+    device_hash[dev.id] = dev
+    device_addr_hash[str(dev.data['device info']['address'])] = dev
+
+
+def _remove_device(dev: Device):
+    devices.remove(dev)
+    device_hash.pop(dev.id, None)
+    device_addr_hash.pop(str(dev.data['device info']['address']), None)
+
+
+def sync_devices(device_list: dict) -> bool:
+    """
+    bring the device tables in line with the device list of elan;
+    only new devices and devices with a changed list entry are fetched
+    :param device_list: result of /api/devices
+    :return: true: something has been changed
+    """
+    global groups
+    changed = False
+    for key in [key for key in device_listing if key not in device_list]:
+        dev = device_listing.pop(key)
+        logger.warning("device {} has been removed from elan".format(dev.url))
+        _remove_device(dev)
+        dev.undiscover()
+        changed = True
+    for key in [key for key in excluded if key not in device_list]:
+        excluded.pop(key)
+    for key, d in device_list.items():
+        old = device_listing.get(key)
+        if (old is not None and old.listing == d) or excluded.get(key) == d:
+            continue
+        try:
+            dev = Device.create(d["url"])
+        except BaseException as be:
+            logger.error("device {} cannot be set up: {}".format(d.get("url"), str(be)))
+            continue
+        dev.listing = d
+        if not policies.included(dev):
+            logger.info("device {} is excluded".format(dev.url))
+            excluded[key] = d
+            if old is not None:
+                device_listing.pop(key)
+                _remove_device(old)
+                old.undiscover()
+                changed = True
+            continue
+        excluded.pop(key, None)
+        if old is not None:
+            logger.warning("device {} has been changed in elan".format(dev.url))
+            _remove_device(old)
+            for topic in set(old.discovery or {}) - set(dev.discovery or {}):
+                mqtt.publish(topic, "", "discovery", retain=True)
+        device_listing[key] = dev
+        _add_device(dev)
+        changed = True
+    if changed:
+        groups = build_groups(elan, config_data['options'].get('groups', {}), devices)
+        build_routes()
+    return changed
+
+
+def build_routes():
+    """
+    build the routing table of the incoming topics: commands, state and history requests of the devices,
+    group commands and the home assistant status; with topic_aliases commands are also accepted
+    on eLan/<label>/command, the label made topic friendly
+    """
+    options = config_data['options']
+    routes: dict[str, Handler] = {options.get('ha_status_topic', 'homeassistant/status'): process_birth}
+    requests: dict[str, RequestHandler] = {}
+    for address, dev in device_addr_hash.items():
+        prefix = dev.policy.topic_prefix + '/' + address
+        routes[dev.control_topic] = dev.process_command
+        routes[prefix + '/history/get'] = functools.partial(process_history, dev)
+        requests[prefix + '/get'] = functools.partial(process_get, dev)
+    for name in groups:
+        routes['eLan/group/' + name + '/command'] = functools.partial(process_group, name)
+    if options.get('topic_aliases', False):
+        names = {address: alias(dev.data['device info'].get('label', '')) for address, dev in device_addr_hash.items()}
+        # an alias of several devices is given to none of them
+        counts = collections.Counter(names.values())
+        for address, dev in device_addr_hash.items():
+            name = names[address]
+            topic = 'eLan/' + name + '/command'
+            if not name or name == "group" or counts[name] > 1 or topic in routes:
+                logger.warning("no alias topic for {}, '{}' is not unique".format(address, name))
+                continue
+            routes[topic] = dev.process_command
+    router.build(routes, requests)
+
+
 def get_devices():
     """
     get list of available devices from elan
     """
-    global devices
-    global elan
-    global device_hash
+    devices.clear()
+    device_hash.clear()
+    device_addr_hash.clear()
+    device_listing.clear()
+    excluded.clear()
     device_list: dict = elan.get('/api/devices')
-    for d in device_list.values():
-        dev = Device.create(d["url"])
-        devices.append(dev)
-        device_hash[dev.id] = dev
-        device_addr_hash[str(dev.data['device info']['address'])] = dev
+    sync_devices(device_list)
+    build_routes()
     # mqtt_client.device_hash = device_hash
     logger.warning(device_list)
     logger.warning(device_hash.keys())
     logger.warning(device_addr_hash.keys())
 
 
+async def check_device_info():
+    """
+    fetch the info of every device and mark the changed ones to be set up again by sync_devices;
+    the device list of elan holds the urls only, changed labels, types or actions are not seen there
+    """
+    for dev in list(device_listing.values()):
+        info = await asyncio.to_thread(elan.get, dev.url)
+        if info and Device.info_fingerprint(info) != dev.fingerprint:
+            logger.warning("info of device {} has been changed in elan".format(dev.url))
+            # differs from any list entry
+            dev.listing = {}
+
+
+async def reconcile_devices():
+    """
+    check the device list of elan for changes in loop
+    """
+    interval = config_data['options'].get('inventory_interval', 0)
+    if not interval:
+        return
+    last_info = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        device_list: dict = await asyncio.to_thread(elan.get, '/api/devices')
+        if not device_list:
+            logger.error("device list is not available, inventory is kept")
+            continue
+        info_interval = config_data['options'].get('inventory_info_interval', 86400)
+        if info_interval and time.time() >= last_info + info_interval:
+            last_info = time.time()
+            await check_device_info()
+        known = set(device_listing.values())
+        if not sync_devices(device_list):
+            continue
+        logger.info("inventory has been updated, {} devices".format(len(devices)))
+        if not config_data['options']['disable_autodiscovery']:
+            for dev in [dev for dev in devices if dev not in known]:
+                await dev.discover()
+
+
 async def publish_all():
     """
     send general publish state messages to mqtt in loop
+    while the websocket delivers the changes the states are only reconciled every publish_interval
+    (or the publish_interval of the device policy), while it is degraded they are polled at least every
+    degraded_publish_interval; after the websocket recovers all devices are published at once,
+    the most recently active first; devices which keep failing are skipped until their next probe,
+    see Device.set_available
     """
-    last_publish = 0
+    started = time.time()
+    # None until the websocket connects for the first time or its max age passes
+    healthy: Optional[bool] = None
     while True:
-        needed = last_publish + config_data['options']['publish_interval'] - time.time()
-        if needed > 0:
-            logger.info("waiting {} secs for the next publish".format(round(needed)))
-            await asyncio.sleep(needed)
-        for dev in devices:
-            dev.publish()
-        last_publish = time.time()
-
+        options = config_data['options']
+        interval = options['publish_interval']
+        degraded: Optional[float] = None
+        catch_up = False
+        if not options.get('disable_websocket', False):
+            max_age = float(options.get('websocket_max_age', 30)) + options['socket_interval']
+            now_healthy = elan.ws_healthy(max_age)
+            if now_healthy or healthy is not None or time.time() - started > max_age:
+                if healthy is not None and now_healthy != healthy:
+                    logger.warning("websocket is {}, polling every {} secs".format(
+                        "healthy" if now_healthy else "degraded",
+                        interval if now_healthy else options.get('degraded_publish_interval', 30)))
+                catch_up = healthy is False and now_healthy
+                healthy = now_healthy
+            if healthy is False:
+                degraded = options.get('degraded_publish_interval', 30)
+        now = time.time()
+        dev: Device
+        if catch_up:
+            order = sorted(devices, key=lambda d: d.last_active, reverse=True)
+        else:
+            order = []
+            for dev in devices:
+                dev_interval = dev.policy.publish_interval or interval
+                if degraded is not None:
+                    dev_interval = min(dev_interval, degraded)
+                if now >= dev.polled + dev_interval:
+                    order.append(dev)
+            if not order:
+                await asyncio.sleep(1)
+                continue
+        for dev in order:
+            dev.polled = now
+            # quarantined devices are only probed, they do not slow down the sweeps
+            if not dev.due():
+                continue
+            # fetched in a thread, the loop keeps serving the lease, mqtt and commands during long sweeps
+            try:
+                await dev.refresh()
+            except asyncio.CancelledError:
+                raise
+            except BaseException as be:
+                logger.error("publishing of {} failed {}".format(dev.url, str(be)))
 
 
 async def discover_all():
@@ -87,80 +294,305 @@ async def discover_all():
             logger.info("waiting {} secs for the next discover".format(round(needed)))
             await asyncio.sleep(needed)
         dev: Device
-        for dev in devices:
+        for dev in list(devices):
             await dev.discover()
         last_discover = time.time()
+        if not config_data['options']['discover_interval']:
+            logger.info("periodic discovery is disabled, waiting for home assistant birth messages")
+            return
+
+
+async def replay_all():
+    """
+    send discovery and the last known states again, from memory
+    """
+    delay = config_data['options'].get('birth_replay_delay', 0.05)
+    # give home assistant some time to subscribe
+    await asyncio.sleep(1)
+    dev: Device
+    for dev in list(devices):
+        if not config_data['options']['disable_autodiscovery']:
+            await dev.discover()
+        dev.republish()
+        await asyncio.sleep(delay)
+    logger.info("discovery and states of {} devices have been replayed".format(len(devices)))
+
+
+async def publish_metrics():
+    """
+    send the collected metrics to mqtt in loop
+    """
+    interval = config_data['options'].get('metrics_interval', 0)
+    if not interval:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        mqtt.publish("eLan/bridge/metrics", json.dumps(metrics.summary()), "metrics")
+
+
+MQTT_OPTIONS = {"mqtt_user", "mqtt_pass", "MQTTserver", "mqtt_port", "mqtt_id", "mqtt_v5", "command_session",
+                "command_max_age"}
+ELAN_OPTIONS = {"username", "password"}
+RESTART_OPTIONS = {"eLanURL"}
+STATIC_OPTIONS = {"spool_dir", "health_port", "loop_monitor", "disable_autodiscovery", "ha_status_topic",
+                  "capture_file", "disable_websocket", "lease_ttl", "lease_id", "memory_diagnostics",
+                  "memory_frames", "device_include", "device_exclude", "device_policies",
+                  "sinks"}
+
+
+class ConfigRestart(Exception):
+    """config change needs the full restart"""
+    pass
+
+
+async def apply_config(new_config: Config):
+    """
+    apply the changed config to the running subsystems, only the affected ones are touched
+    :param new_config: config read from the changed file
+    """
+    changed = config_data.changes(new_config)
+    logger.warning("config has been changed: {}".format(sorted(changed)))
+    config_data.data = new_config.data
+    config_data.mtime = new_config.mtime
+    if changed & RESTART_OPTIONS:
+        raise ConfigRestart("changed options need restart: {}".format(sorted(changed & RESTART_OPTIONS)))
+    if "logging" in changed:
+        set_log_level(config_data)
+    if changed & ELAN_OPTIONS:
+        elan.setup(config_data)
+        elan.cookie = None
+    mqtt.setup(config_data)
+    if changed & MQTT_OPTIONS:
+        mqtt.reconnect()
+    scheduler.setup(config_data)
+    health.setup(config_data)
+    monitor.setup(config_data)
+    telemetry.setup(config_data)
+    diagnostics.setup(config_data)
+    Device.init(elan, mqtt, config_data, scheduler, telemetry, policies)
+    dev: Device
+    if "command_validation" in changed:
+        for dev in devices:
+            dev.compile_validator()
+    if "attribute_topics" in changed:
+        for dev in devices:
+            dev.set_discovery(dev.kind)
+            if not config_data['options']['disable_autodiscovery']:
+                await dev.discover()
+    if "groups" in changed:
+        global groups
+        groups = build_groups(elan, config_data['options'].get('groups', {}), devices)
+    build_routes()
+    if changed & STATIC_OPTIONS:
+        logger.warning("options {} are applied on the next restart".format(sorted(changed & STATIC_OPTIONS)))
+
+
+async def watch_config():
+    """
+    check the config file for changes in loop
+    """
+    while True:
+        await asyncio.sleep(config_data['options'].get('config_check_interval', 5))
+        if not config_data.modified():
+            continue
+        try:
+            new_config = Config(config_data.filename)
+        except BaseException:
+            logger.error("changed config cannot be loaded, keeping the old one")
+            config_data.mtime = os.path.getmtime(config_data.filename)
+            continue
+        await apply_config(new_config)
 
 
 async def elan_ws() -> None:
     """
     elan websocket listener loop
     """
-    def publisher(device: str):
-        global device_hash
+    fetching: set[asyncio.Task] = set()
 
+    async def fetch(dev: Device):
         try:
-            device_hash[device].publish()
-        except KeyError:
-            pass
+            await dev.refresh()
+        except BaseException as be:
+            logger.error("publishing of {} failed {}".format(dev.url, str(be)))
+
+    def publisher(device: str):
+        dev = device_hash.get(device)
+        if dev is None:
+            return
+        # fetched in a thread, the events of one device share a single request to elan
+        task = asyncio.create_task(fetch(dev))
+        fetching.add(task)
+        task.add_done_callback(fetching.discard)
 
     last_socket = 0
     while True:
-        needed = last_socket + config_data['options']['socket_interval'] - time.time()
+        # at least 1 s between websocket sessions, they can end immediately on errors
+        needed = last_socket + max(1, config_data['options']['socket_interval']) - time.time()
         if needed > 0:
             logger.info("waiting {} secs for the next websocket".format(round(needed)))
             await asyncio.sleep(needed)
         try:
             await elan.ws_listen(publisher)
         except BaseException as e:
-            logger.error("ws listener error", e)
+            logger.error("ws listener error: {}".format(str(e)))
             raise
 
         last_socket = time.time()
 
 
-async def process_event(address: str, payload: str):
+async def process_group(name: str, payload: str):
+    """
+    handle command of the given group
+    :param name: name of the group
+    :param payload: command to send to all members
+    """
+    if name not in groups:
+        logger.error("unknown group {}".format(name))
+        return
+    await groups[name].process_command(payload, config_data['options'].get('group_concurrency', 4))
+
+async def process_get(dev: Device, payload: str, reply: Optional[Reply]):
     """
-    handle event on the given device
-    :param address: address of the device
-    :param payload: command to process
+    answer a state request of a device from the cache if it is younger than state_max_age,
+    otherwise from elan; the state is sent to the mqtt v5 response topic of the request if it has one,
+    else it is published on the status topic
+    :param dev: device
+    :param payload: ignored
+    :param reply: response topic and correlation data of the request
     """
-    if address in device_addr_hash:
-        await device_addr_hash[address].process_command(payload)
+    age = time.time() - dev.state_time
+    if dev.state_raw is not None and age <= config_data['options'].get('state_max_age', 10):
+        metrics.metric("state_cache_age").add(age)
+        raw = dev.state_raw
+        if reply is None:
+            dev.republish()
     else:
-        logger.error("process_event error occurred")
-        logger.error(address)
-        logger.error(payload)
-        logger.error(device_hash)
+        # publishes the fetched state on the status topic
+        raw = await dev.refresh()
+    if reply is not None:
+        mqtt.reply(reply[0], raw if raw is not None else json.dumps({"error": "state is not available"}), reply[1])
 
-def _start_async():
-    loop = asyncio.new_event_loop()
-    threading.Thread(target=elan_ws_runner, args=(loop, )).start()
-    return loop
 
-def elan_ws_runner(_loop):
-    asyncio.run_coroutine_threadsafe(elan_ws(), _loop)
+def process_history(dev: Device, payload: str):
+    """
+    answer a history request of a device on eLan/<mac>/history
+    :param dev: device
+    :param payload: json request, see Telemetry.query, may be empty
+    """
+    address = dev.mac
+    try:
+        request = json.loads(payload) if payload.strip() else {}
+        if not isinstance(request, dict):
+            raise ValueError("request is not an object")
+        result = telemetry.query(address, request)
+    except (ValueError, TypeError) as e:
+        logger.warning("invalid history request for {}: {}".format(address, str(e)))
+        result = {"error": str(e)}
+    mqtt.publish(dev.policy.topic_prefix + '/' + address + '/history', json.dumps(result), "history")
 
-async def main():
-    global logger
-    asyncio.current_task().set_name("main")
 
-    mqtt.connect()
+def cache_status(address: str, payload: bytes):
+    """
+    keep the state published by the leader, so a standby can take over with warm states
+    :param address: mac of the device
+    :param payload: published state
+    """
+    dev = device_addr_hash.get(address)
+    if dev is not None:
+        dev.cache_state(payload)
 
-    logger.info("{} devices have been found in eLan".format(len(devices)))
 
-    _loop = _start_async()
+def set_role(supervisor: Supervisor, leader: bool):
+    """
+    start the tasks of the leader or stop them on standby
+    :param supervisor: supervisor of the tasks
+    :param leader: true: this instance holds the lease
+    """
+    if mqtt_client.MqttClient.muted == leader:
+        mqtt_client.MqttClient.muted = not leader
+        # only the leader leaves the will setting the bridge offline
+        mqtt.reconnect({"publish"})
+    health.standby = not leader
+    for name in LEADER_TASKS:
+        if name not in supervisor.subsystems:
+            continue
+        if leader:
+            supervisor.start(name)
+        else:
+            supervisor.stop(name)
+
+
+def process_birth(payload: str):
+    """
+    handle home assistant status message
+    :param payload: online or offline
+    """
+    global replay_task
+    logger.info("home assistant is {}".format(payload))
+    if payload != "online":
+        return
+    if replay_task is not None and not replay_task.done():
+        replay_task.cancel()
+    replay_task = asyncio.create_task(replay_all(), name="replay")
 
+async def main():
+    global logger
+    asyncio.current_task().set_name("main")
 
-    async with TaskGroup() as group:
-        group.create_task(publish_all(), name="publish")
-        if not config_data['options']['disable_autodiscovery']:
-            group.create_task(discover_all(), name="discover")
-#        group.create_task(asyncio.to_thread(elan_ws), name="websocket")
-        group.create_task(mqtt.do_publish(), name="mqtt")
-        group.create_task(mqtt.listen("eLan/+/command", process_event), name="subscribe")
+    logger.info("{} devices have been found in eLan".format(len(devices)))
 
-        logger.info("all tasks have been created {}".format(asyncio.all_tasks()))
+    supervisor = Supervisor()
+    supervisor.setup(config_data)
+    health.restarter = supervisor.restart
+    # with a lease the instance starts as standby
+    standby = lease.enabled
+    mqtt_client.MqttClient.muted = standby
+    health.standby = standby
+    mqtt.connect()
+    lease.on_change = functools.partial(set_role, supervisor)
+    lease.on_status = cache_status
+    supervisor.add("publish", publish_all, enabled=not standby)
+    if not config_data['options']['disable_autodiscovery']:
+        supervisor.add("discover", discover_all, enabled=not standby)
+    if not config_data['options'].get('disable_websocket', False):
+        supervisor.add("websocket", elan_ws, enabled=not standby)
+    supervisor.add("mqtt", mqtt.do_publish)
+    supervisor.add("scheduler", scheduler.run)
+    supervisor.add("metrics", publish_metrics)
+    supervisor.add("health", health.serve)
+    supervisor.add("watchdog", health.watchdog)
+    supervisor.add("monitor", monitor.run)
+    supervisor.add("config", watch_config, policy="escalate")
+    supervisor.add("inventory", reconcile_devices)
+    # device topics of all prefixes of the device policies
+    prefixes = sorted({'eLan'} | {dev.policy.topic_prefix for dev in devices})
+    lease.status_topics = [prefix + "/+/status" for prefix in prefixes]
+    topics = [prefix + level for prefix in prefixes for level in ("/+/command", "/+/get", "/+/history/get")]
+    supervisor.add("subscribe", lambda: mqtt.listen(
+        topics + ["eLan/group/+/command", config_data['options'].get('ha_status_topic', 'homeassistant/status')],
+        router.dispatch), enabled=not standby)
+    supervisor.add("lease", lease.run)
+    health.sinks = bus.sinks
+    for sink in bus.sinks:
+        supervisor.add("sink " + sink.name, sink.run)
+        diagnostics.gauges["sink " + sink.name] = functools.partial(len, sink.queue)
+    diagnostics.gauges.update({
+        "devices": lambda: len(devices),
+        "device_hash": lambda: len(device_hash),
+        "device_addr_hash": lambda: len(device_addr_hash),
+        "outbound_queue": lambda: len(mqtt.queue),
+        "outbound_queue_bytes": lambda: mqtt.queue.bytes,
+        "spool_bytes": lambda: mqtt.spool.size() if mqtt.spool is not None else 0,
+        "scheduler_pending": scheduler.pending,
+        "routes": lambda: len(router.routes) + len(router.requests),
+        "telemetry_samples": lambda: sum(ring.count for ring in telemetry.rings.values()),
+        "metrics_samples": lambda: sum(len(m.samples) for m in metrics.registry.values()),
+        "tasks": lambda: len(asyncio.all_tasks()),
+    })
+    supervisor.add("diagnostics", diagnostics.run, policy="temporary")
+
+    await supervisor.run()
 
     while True:
         logger.info("running tasks: {}".format(len(asyncio.all_tasks())))
@@ -179,6 +611,29 @@ def str2bool(v) -> bool:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def start(config: Config):
+    """
+    configure all components and read the devices
+    :param config: config to use
+    """
+    global config_data
+    config_data = config
+    elan.setup(config_data)
+    mqtt.setup(config_data)
+    scheduler.setup(config_data)
+    health.setup(config_data)
+    monitor.setup(config_data)
+    recorder.setup(config_data)
+    lease.setup(config_data)
+    diagnostics.setup(config_data)
+    telemetry.setup(config_data)
+    policies.setup(config_data)
+    bus.setup(config_data)
+    mqtt_client.MqttClient.fan_out = bus.publish if bus.sinks else None
+    Device.init(elan, mqtt, config_data, scheduler, telemetry, policies)
+    get_devices()
+
+
 if __name__ == '__main__':
     # parse arguments
     config_data = read_config()
@@ -188,11 +643,7 @@ if __name__ == '__main__':
     # Any error will trigger new startup
     while True:
         try:
-            read_config()
-            elan.setup(config_data)
-            mqtt.setup(config_data)
-            Device.init(elan, mqtt)
-            get_devices()
+            start(read_config())
 
             asyncio.run(main())
         except KeyboardInterrupt:
@@ -203,3 +654,4 @@ if __name__ == '__main__':
                 exc_info=True)
 
         logger.error("But at first take some break. Sleeping for 10 s")
+        time.sleep(10)
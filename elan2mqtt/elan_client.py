@@ -3,11 +3,13 @@ import datetime
 import hashlib
 import json
 import logging
+import time
 from collections.abc import Callable
 from typing import Optional
 
 import aiologic
 from websockets import InvalidStatus, ConnectionClosedError
+from capture import recorder
 from config import Config
 
 
@@ -28,6 +30,10 @@ class ElanClient:
         self.elan_url: Optional[str] = None
         self.logged_in: bool = False
         self.cookie: Optional[str] = None
+        self.last_get: float = 0
+        self.last_event: float = 0
+        # last websocket handshake or event, the websocket is healthy while it is fresh
+        self.last_ws: float = 0
 
     def setup(self, data: Config) -> None:
         """configure this elan client"""
@@ -66,11 +72,11 @@ class ElanClient:
             logger.error(msg)
         return False
 
-    def get(self, url: str) -> dict:
+    def _get_response(self, url: str) -> Optional[requests.Response]:
         """
-        get data from the given address
+        get the response of the given address, reconnect and retry on errors
         :param url: device api endpoint
-        :return: dict returned from url
+        :return: accepted response or None
         """
         if url[0:4] != 'http':
             url = self.elan_url + url
@@ -83,13 +89,42 @@ class ElanClient:
                 headers = {"Cookie": "AuthAPI={}".format(self.cookie)}
                 response = requests.get(url=url , headers=headers, timeout=10)
                 if self.check_response(response):
-                    return response.json()
+                    self.last_get = time.time()
+                    if recorder.enabled:
+                        recorder.record("get", url, response.text)
+                    return response
                 logger.debug("invalid response, retrying")
             except BaseException as bee:
                 logger.error("trying to get failed (retrying #{}): {}".format(i, str(bee)))
             reconnect = True
+        return None
+
+    def get(self, url: str) -> dict:
+        """
+        get data from the given address
+        :param url: device api endpoint
+        :return: dict returned from url
+        """
+        response = self._get_response(url)
+        if response is None:
+            return {}
+        try:
+            return response.json()
+        except BaseException as bee:
+            logger.error("invalid json received from {}: {}".format(url, str(bee)))
         return {}
 
+    def get_raw(self, url: str) -> Optional[bytes]:
+        """
+        get the unparsed body of the given address
+        :param url: device api endpoint
+        :return: response body or None if it cannot be fetched
+        """
+        response = self._get_response(url)
+        if response is None:
+            return None
+        return response.content
+
     def post(self, url: str, data=None) -> requests.Response:
         """
         post a message to elan
@@ -118,6 +153,8 @@ class ElanClient:
         logger.debug("trying to put {}".format(url))
         response = requests.put(url=url, headers=headers, data=data)
         self.check_response(response)
+        if recorder.enabled:
+            recorder.record("put", url, {"data": data, "result": response.text})
         return response.text
 
 
@@ -160,14 +197,18 @@ class ElanClient:
         logger.debug("checking ws at {}".format(ws_host))
         try:
             async for ws in ws_connect(ws_host, additional_headers=headers, ping_timeout=1000):
-
+                self.last_ws = time.time()
                 data: dict = json.loads(await asyncio.wait_for(ws.recv(), timeout=10))
                 logger.debug("received {}".format(data))
+                self.last_event = time.time()
+                self.last_ws = self.last_event
+                if recorder.enabled:
+                    recorder.record("event", str(data['device']))
                 publisher(data['device'])
         except asyncio.exceptions.CancelledError as ece:
             logger.error("websocket cancelled: {}".format(str(ece)))
             self.cookie = None
-            # raise
+            raise
         except InvalidStatus as ise:
             logger.error("websocket invalid status: {}".format(str(ise)))
             self.cookie = None
@@ -186,6 +227,10 @@ class ElanClient:
         await asyncio.sleep(0)
 
 
+    def ws_healthy(self, max_age: float) -> bool:
+        """true if the websocket has connected or delivered an event in the last max_age seconds"""
+        return time.time() - self.last_ws <= max_age
+
     def get_login_cookie(self) -> None:
         name = self.creds.get("name")
         key = self.creds.get("key")
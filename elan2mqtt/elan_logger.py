@@ -21,7 +21,16 @@ def set_logger(config: Config):
         return record
 
     logging.setLogRecordFactory(record_factory)
+    logging.basicConfig(level=_level(log_level), format=formatter)
+
+
+def _level(log_level: str) -> int:
     numeric_level = getattr(logging, log_level.upper(), None)
     if not isinstance(numeric_level, int):
         numeric_level = 30
-    logging.basicConfig(level=numeric_level, format=formatter)
+    return numeric_level
+
+
+def set_log_level(config: Config):
+    """change the log level of the running logger"""
+    logging.getLogger().setLevel(_level(config["logging"]["log_level"]))
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+
+from device import Device
+from elan_client import ElanClient
+from policy import Rule
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Group:
+    """
+    named set of devices commanded together
+    the rule may contain: devices (list of mac addresses), label (regex), type, product, kind, room;
+    a device is a member if it is listed or if it matches every other given item
+    """
+
+    def __init__(self, name: str, rule: dict):
+        """
+        init group
+        :param name: name of the group, used in its topic
+        :param rule: membership rule from config
+        """
+        self.name = name
+        self.rule = rule
+        self.selection = Rule(rule)
+        self.members: list[Device] = []
+
+    def matches(self, dev: Device, rooms: dict[str, set]) -> bool:
+        """
+        check membership of the device
+        :param dev: device to check
+        :param rooms: device ids of the rooms by room label
+        """
+        return self.selection.matches(dev, rooms)
+
+    async def process_command(self, data: str, concurrency: int):
+        """
+        send the command to all members, then refresh their states at once;
+        the commands are all handed to the scheduler, which limits them by command_concurrency
+        :param data: command payload
+        :param concurrency: max number of state fetches in flight
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def send(dev: Device) -> bool:
+            try:
+                return await dev.send_command(data)
+            except BaseException as be:
+                logger.error("command for {} failed {}".format(dev.url, str(be)))
+                return False
+
+        async def fetch(dev: Device):
+            async with semaphore:
+                return await asyncio.to_thread(dev.elan.get_raw, dev.url + '/state')
+
+        sent = await asyncio.gather(*(send(dev) for dev in self.members))
+        logger.info("group {}: {} of {} commands sent".format(self.name, sum(sent), len(sent)))
+        # optimistic devices are not asked for the state after a command
+        targets = [dev for dev, ok in zip(self.members, sent) if ok and not dev.policy.optimistic]
+        states = await asyncio.gather(*(fetch(dev) for dev in targets), return_exceptions=True)
+        for dev, raw in zip(targets, states):
+            if isinstance(raw, BaseException):
+                logger.error("state of {} failed {}".format(dev.url, str(raw)))
+                continue
+            dev.publish_state(raw)
+
+
+def get_rooms(elan: ElanClient) -> dict[str, set]:
+    """
+    get device ids of the rooms defined in elan
+    :return: set of device ids by room label
+    """
+    rooms: dict[str, set] = {}
+    for r in elan.get('/api/rooms').values():
+        room = elan.get(r['url'])
+        label = room.get('room info', {}).get('label')
+        if label:
+            rooms[label] = set(str(k) for k in room.get('devices', {}).keys())
+    return rooms
+
+
+def build_groups(elan: ElanClient, config: dict, devices: list[Device]) -> dict[str, Group]:
+    """
+    create the configured groups
+    :param elan: elan client, used to read the rooms if needed
+    :param config: groups section of the config
+    :param devices: all known devices
+    :return: groups by name
+    """
+    groups = {name: Group(name, rule) for name, rule in config.items()}
+    rooms: dict[str, set] = {}
+    if any('room' in g.rule for g in groups.values()):
+        try:
+            rooms = get_rooms(elan)
+        except BaseException as be:
+            logger.error("reading of rooms failed {}".format(str(be)))
+    for group in groups.values():
+        group.members = [dev for dev in devices if group.matches(dev, rooms)]
+        logger.info("group {} has {} members".format(group.name, len(group.members)))
+    return groups
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import time
+from collections.abc import Callable
+from typing import Optional
+
+from bus import Sink
+from config import Config
+from elan_client import ElanClient
+from mqtt_client import MqttClient
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class WatchdogError(Exception):
+    """a subsystem has stalled"""
+    pass
+
+
+class Health:
+    """
+    freshness of the subsystems, served over http and checked by the watchdog
+    a subsystem is stalled if its last activity is older than its limit, 0 means not checked
+    """
+
+    # task restarted by the watchdog when a subsystem stalls
+    TASKS = {"elan": "publish", "websocket": "websocket", "mqtt": "mqtt", "queue": "mqtt"}
+
+    def __init__(self, elan: ElanClient, mqtt: MqttClient):
+        self.elan = elan
+        self.mqtt = mqtt
+        self.started = time.time()
+        self.port = 0
+        self.interval = 10
+        self.restart = False
+        self.limits: dict[str, float] = {}
+        self.restarter: Optional[Callable[[str], None]] = None
+        self.restarted: dict[str, float] = {}
+        # a standby instance neither polls eLan nor publishes, those checks are skipped
+        self.standby = False
+        # reported only, a slow sink must not make the gateway unready
+        self.sinks: list[Sink] = []
+
+    def setup(self, config: Config) -> None:
+        """configure health checks"""
+        options = config['options']
+        self.port = int(options.get('health_port', 0))
+        self.interval = float(options.get('watchdog_interval', 10))
+        self.restart = bool(options.get('watchdog_restart', False))
+        self.limits = {
+            "elan": float(options.get('max_elan_age', 3 * options['publish_interval'] + 60)),
+            # no events come without the websocket
+            "websocket": 0 if options.get('disable_websocket', False) else float(options.get('max_event_age', 0)),
+            "mqtt": float(options.get('max_publish_age', 0)),
+            "queue": float(options.get('max_queue_age', 60)),
+        }
+
+    def _age(self, timestamp: float) -> float:
+        return time.time() - max(timestamp, self.started)
+
+    def report(self) -> dict:
+        """freshness of all subsystems"""
+        ages = {
+            "elan": self._age(self.elan.last_get),
+            "websocket": self._age(self.elan.last_event),
+            "mqtt": self._age(self.mqtt.last_publish),
+            "queue": self.mqtt.queue.oldest_age(),
+        }
+        subsystems = {}
+        for name, age in ages.items():
+            limit = 0 if self.standby and name != "queue" else self.limits.get(name, 0)
+            subsystems[name] = {"age": round(age, 3), "max": limit, "ok": not limit or age <= limit}
+        return {
+            "ok": all(s["ok"] for s in subsystems.values()),
+            "role": "standby" if self.standby else "leader",
+            "uptime": round(time.time() - self.started, 3),
+            "pending": len(self.mqtt.queue),
+            "subsystems": subsystems,
+            "sinks": {sink.name: {"pending": len(sink.queue), "age": round(sink.queue.oldest_age(), 3),
+                                  "sent": sink.sent, "dropped": sink.queue.dropped} for sink in self.sinks},
+        }
+
+    def stalled(self) -> list[str]:
+        """names of the stalled subsystems"""
+        return [name for name, s in self.report()["subsystems"].items() if not s["ok"]]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """answer one http request: /health is liveness, /ready fails if anything is stalled"""
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            parts = request.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else "/"
+            report = self.report()
+            if path == "/health":
+                status = "200 OK"
+            elif path == "/ready":
+                status = "200 OK" if report["ok"] else "503 Service Unavailable"
+            else:
+                status = "404 Not Found"
+            body = json.dumps(report).encode()
+            writer.write("HTTP/1.0 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                status, len(body)).encode() + body)
+            await writer.drain()
+        except BaseException as be:
+            logger.debug("health request failed: {}".format(str(be)))
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        """run the health http endpoint"""
+        if not self.port:
+            return
+        server = await asyncio.start_server(self._handle, port=self.port)
+        logger.info("health endpoint is listening on port {}".format(self.port))
+        async with server:
+            await server.serve_forever()
+
+    async def watchdog(self) -> None:
+        """
+        check the subsystems in loop; if restart is enabled, the task of a stalled subsystem is restarted,
+        once per its limit; WatchdogError is raised if there is no restarter
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            stalled = self.stalled()
+            if not stalled:
+                continue
+            logger.error("stalled subsystems: {}".format(stalled))
+            if not self.restart:
+                continue
+            if self.restarter is None:
+                raise WatchdogError("stalled subsystems: {}".format(stalled))
+            now = time.time()
+            for name in stalled:
+                if now - self.restarted.get(name, 0) < self.limits[name]:
+                    continue
+                self.restarted[name] = now
+                self.restarter(self.TASKS[name])
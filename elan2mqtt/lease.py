@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import socket
+import time
+from collections.abc import Callable
+from typing import Optional
+
+import aiomqtt
+
+from config import Config
+from mqtt_client import MqttClient
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Lease:
+    """
+    leadership among gateway instances running against the same eLan and broker;
+    the leader renews a retained lease message, a standby takes over when the lease has not been renewed
+    for ttl seconds or has been released. The will of the lease connection releases the lease if the leader dies.
+    """
+
+    TOPIC = "eLan/bridge/lease"
+
+    def __init__(self, mqtt: MqttClient):
+        """
+        init lease
+        :param mqtt: client giving the broker settings
+        """
+        self.mqtt = mqtt
+        self.ttl = 0.0
+        self.owner = socket.gethostname()
+        self.leader = False
+        self.holder: Optional[str] = None
+        # monotonic time of the last renewal of the holder
+        self.renewed = 0.0
+        self.last_renew = 0.0
+        self.on_change: Optional[Callable[[bool], None]] = None
+        self.on_status: Optional[Callable[[str, bytes], None]] = None
+        # states published by the leader, kept by a standby
+        self.status_topics = ["eLan/+/status"]
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def setup(self, config: Config) -> None:
+        """configure the lease, lease_ttl 0 disables it and this instance is always the leader"""
+        self.ttl = float(config['options'].get('lease_ttl', 0))
+        self.owner = config['options'].get('lease_id') or socket.gethostname()
+
+    def _lease(self, released: bool = False) -> str:
+        lease = {"owner": self.owner, "ttl": self.ttl, "renewed": time.time()}
+        if released:
+            lease["released"] = True
+        return json.dumps(lease)
+
+    def _set_leader(self, leader: bool) -> None:
+        if leader == self.leader:
+            return
+        self.leader = leader
+        logger.warning("{} is {}".format(self.owner, "the leader" if leader else "standby"))
+        if self.on_change is not None:
+            self.on_change(leader)
+
+    def received(self, payload: bytes, retained: bool = False) -> None:
+        """
+        process a lease message of any instance
+        :param payload: lease json
+        :param retained: the message has been kept by the broker, it may have been renewed a while ago
+        """
+        try:
+            lease = json.loads(payload)
+            owner = str(lease['owner'])
+        except (ValueError, TypeError, KeyError):
+            return
+        if owner == self.owner:
+            return
+        if lease.get('released'):
+            if owner == self.holder:
+                logger.warning("lease has been released by {}".format(owner))
+                self.holder = None
+            return
+        if self.leader:
+            # two leaders after claiming at the same time: the lower id keeps the lease
+            if owner > self.owner:
+                return
+            self._set_leader(False)
+        self.holder = owner
+        if retained:
+            # a retained lease can be old already, its age is taken from the clock of the owner
+            age = min(self.ttl, max(0.0, time.time() - float(lease.get('renewed', time.time()))))
+            self.renewed = time.monotonic() - age
+        else:
+            # a live renewal is fresh, whatever the clock of the owner says
+            self.renewed = time.monotonic()
+
+    async def _read(self, client: aiomqtt.Client) -> None:
+        async for message in client.messages:
+            topic = message.topic.value
+            if topic == self.TOPIC:
+                self.received(message.payload, message.retain)
+            elif not self.leader and self.on_status is not None:
+                self.on_status(topic.split("/")[-2], message.payload)
+
+    async def _tick(self, client: aiomqtt.Client) -> None:
+        # give the retained lease time to arrive
+        await asyncio.sleep(1)
+        try:
+            while True:
+                now = time.monotonic()
+                if self.leader:
+                    if now - self.last_renew >= self.ttl / 3:
+                        await client.publish(self.TOPIC, self._lease(), retain=True)
+                        self.last_renew = now
+                elif self.holder is None or now - self.renewed > self.ttl:
+                    if self.holder is None:
+                        logger.warning("no lease is held, taking over")
+                    else:
+                        logger.warning("lease of {} has expired, taking over".format(self.holder))
+                    await client.publish(self.TOPIC, self._lease(), retain=True)
+                    self.last_renew = now
+                    self.holder = self.owner
+                    self._set_leader(True)
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            # the leader keeps leading if the broker is lost or the session is reopened with new settings,
+            # it steps down only if the release has been sent
+            if self.leader and "lease" not in self.mqtt.reconnecting:
+                try:
+                    await client.publish(self.TOPIC, self._lease(released=True), retain=True)
+                    self.holder = None
+                    self._set_leader(False)
+                except aiomqtt.MqttError:
+                    pass
+            raise
+
+    async def _session(self) -> None:
+        """hold or watch the lease on one connection"""
+        will = aiomqtt.Will(self.TOPIC, self._lease(released=True))
+        async with aiomqtt.Client(hostname=self.mqtt.url, port=self.mqtt.port, username=self.mqtt.username,
+                                  password=self.mqtt.password, protocol=self.mqtt.protocol, will=will,
+                                  logger=logger) as client:
+            self.mqtt.reconnecting.discard("lease")
+            await client.subscribe(self.TOPIC)
+            for topic in self.status_topics:
+                await client.subscribe(topic)
+            async with asyncio.TaskGroup() as group:
+                group.create_task(self._read(client))
+                group.create_task(self._tick(client))
+
+    async def run(self) -> None:
+        """take part in the election in loop, without lease this instance leads at once"""
+        if not self.enabled:
+            self._set_leader(True)
+            return
+        logger.info("{} is standby until it gets the lease".format(self.owner))
+        while True:
+            try:
+                await self.mqtt._session(self._session(), "lease")
+            except asyncio.CancelledError:
+                raise
+            except aiomqtt.MqttError as mexc:
+                logger.error("lease mqtt error: {}".format(str(mexc)))
+            except BaseException as bexc:
+                logger.error("lease error: {}".format(str(bexc)))
+            await asyncio.sleep(1)
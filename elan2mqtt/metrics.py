@@ -0,0 +1,105 @@
+import bisect
+import logging
+from collections import deque
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Metric:
+    """rolling window of numeric samples"""
+
+    def __init__(self, size: int = 1000):
+        """
+        init metric
+        :param size: number of samples kept for the statistics
+        """
+        self.samples: deque = deque(maxlen=size)
+        self.count: int = 0
+
+    def add(self, value: float) -> None:
+        """record one sample"""
+        self.samples.append(value)
+        self.count += 1
+
+    def percentile(self, p: float) -> float:
+        """
+        percentile of the kept samples
+        :param p: percentile, 0 - 100
+        """
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def summary(self) -> dict:
+        """statistics of the kept samples"""
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+        size = len(ordered)
+        return {
+            "count": self.count,
+            "min": round(ordered[0], 6),
+            "max": round(ordered[-1], 6),
+            "avg": round(sum(ordered) / size, 6),
+            "p50": round(ordered[int(size * 0.5)], 6),
+            "p90": round(ordered[min(size - 1, int(size * 0.9))], 6),
+            "p99": round(ordered[min(size - 1, int(size * 0.99))], 6),
+        }
+
+
+class Histogram:
+    """counts of samples in fixed buckets, for values whose distribution matters over all time"""
+
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+    def __init__(self, bounds: tuple = BOUNDS):
+        """
+        init histogram
+        :param bounds: upper bounds of the buckets, one more bucket takes the larger values
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        """record one sample"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def summary(self) -> dict:
+        """count, average and the count of each bucket keyed by its upper bound"""
+        buckets = {str(bound): n for bound, n in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 6) if self.count else 0.0,
+            "buckets": buckets,
+        }
+
+
+registry: dict[str, Metric] = {}
+histograms: dict[str, Histogram] = {}
+
+
+def metric(name: str) -> Metric:
+    """get the named metric, create it on first use"""
+    if name not in registry:
+        registry[name] = Metric()
+    return registry[name]
+
+
+def histogram(name: str) -> Histogram:
+    """get the named histogram, create it on first use"""
+    if name not in histograms:
+        histograms[name] = Histogram()
+    return histograms[name]
+
+
+def summary() -> dict:
+    """statistics of all metrics and histograms"""
+    result = {name: m.summary() for name, m in registry.items()}
+    result.update((name, h.summary()) for name, h in histograms.items())
+    return result
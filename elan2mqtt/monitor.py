@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Optional
+
+import metrics
+from config import Config
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """
+    measures the scheduling lag of the event loop;
+    a watcher thread reports the stack of any callback blocking the loop longer than the threshold
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 0.1
+        self.threshold = 0.2
+        self.heartbeat: float = 0
+        self.running = False
+
+    def setup(self, config: Config) -> None:
+        """configure the monitor"""
+        self.enabled = bool(config['options'].get('loop_monitor', False))
+        self.threshold = float(config['options'].get('loop_block_ms', 200)) / 1000
+
+    @staticmethod
+    def _device(frame: Optional[FrameType]) -> Optional[str]:
+        """find the device being processed in the stack"""
+        while frame is not None:
+            for name in ("self", "dev"):
+                obj = frame.f_locals.get(name)
+                if type(obj).__name__ == "Device":
+                    return obj.url
+            frame = frame.f_back
+        return None
+
+    def _watch(self, thread_id: int) -> None:
+        """watcher thread: report the loop stack if the heartbeat stops"""
+        reported = 0.0
+        while self.running:
+            time.sleep(self.threshold / 2)
+            beat = self.heartbeat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning("event loop blocked for {} ms, device: {}\n{}".format(
+                round(blocked * 1000), self._device(frame), stack))
+
+    async def run(self) -> None:
+        """measure loop lag in loop"""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        self.heartbeat = time.monotonic()
+        self.running = True
+        threading.Thread(target=self._watch, args=(threading.get_ident(),), name="loop-monitor", daemon=True).start()
+        logger.info("loop monitor is running, block threshold {} ms".format(round(self.threshold * 1000)))
+        lag_metric = metrics.metric("loop_lag")
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                self.heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = loop.time() - expected
+                lag_metric.add(lag)
+                if lag >= self.threshold:
+                    metrics.metric("loop_blocked").add(lag)
+        finally:
+            self.running = False
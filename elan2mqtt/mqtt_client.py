@@ -1,94 +1,471 @@
 import asyncio
-from asyncio import Queue
-from typing import Callable, Coroutine, Any
+import contextlib
+import time
+from collections import OrderedDict
+from typing import Callable, Coroutine, Any, Union, Optional
 
 import aiomqtt
 import logging
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from capture import recorder
 from config import Config
+from spool import Spool
 
 logger = logging.getLogger(__name__)
 
+# retained online/offline of the whole gateway, the leader publishes it and leaves it offline by its will
+AVAILABILITY = "eLan/bridge/availability"
+
 class PublishData:
-    def __init__(self, topic: str, payload: str, message: str):
+    def __init__(self, topic: str, payload: Union[str, bytes], message: str, retain: bool = False,
+                 correlation: Optional[bytes] = None, qos: int = 0):
         """
         init publish data struct
         :param topic: topic
-        :param payload:payload
+        :param payload:payload, a str is encoded once here for the broker and all sinks
         :param message:message
+        :param retain: retain flag of the message
+        :param correlation: mqtt v5 correlation data of a reply
+        :param qos: mqtt qos of the message
         """
         self.topic = topic
-        self.payload = payload
+        self.payload = payload.encode('utf-8') if isinstance(payload, str) else payload
         self.message = message
+        self.retain = retain
+        self.correlation = correlation
+        self.qos = qos
+        # replies to the same response topic must not replace each other in the queue
+        self.key = topic if correlation is None else topic + "\0" + correlation.hex()
+        self.created = time.time()
+
+    def size(self) -> int:
+        """approximate memory used by the message"""
+        return len(self.topic) + len(self.payload)
+
+
+class OutboundQueue:
+    """
+    pending messages keyed by topic (and correlation data of replies), in order of their first arrival;
+    a newer message replaces the pending one of its topic in place, so there is one message per topic at most.
+    Above the memory cap messages are dropped by priority of their kind, lowest first:
+    'oldest' drops the oldest pending message of that priority, 'newest' drops the incoming one
+    """
+
+    PRIORITY = {"metrics": 0, "history": 0, "status": 1, "reply": 1, "attribute": 1, "discovery": 2,
+                "availability": 2, "error": 3}
+    DROP_POLICY = {0: "newest", 1: "oldest", 2: "oldest", 3: "oldest"}
+
+    def __init__(self, max_bytes: int = 1024 * 1024, name: str = "outbound queue"):
+        """
+        init queue
+        :param max_bytes: memory cap of the pending payloads
+        :param name: name of the queue in logs
+        """
+        self.max_bytes = max_bytes
+        self.name = name
+        self.items: OrderedDict[str, PublishData] = OrderedDict()
+        # arrival of the first pending message of each key, messages are shared by queues and not changed
+        self.arrived: dict[str, float] = {}
+        self.levels: dict[int, OrderedDict[str, None]] = {}
+        self.bytes = 0
+        self.dropped = 0
+        self.event: Optional[asyncio.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def empty(self) -> bool:
+        return not self.items
+
+    def _priority(self, pdata: PublishData) -> int:
+        return self.PRIORITY.get(pdata.message, 1)
+
+    def _remove(self, key: str) -> PublishData:
+        pdata = self.items.pop(key)
+        self.arrived.pop(key, None)
+        self.levels[self._priority(pdata)].pop(key, None)
+        self.bytes -= pdata.size()
+        return pdata
+
+    def _make_room(self, pdata: PublishData, old: Optional[PublishData] = None) -> bool:
+        """
+        drop messages so the new one fits under the cap, nothing is dropped if it would not fit anyway
+        :param pdata: new message
+        :param old: pending message replaced by the new one, it is not counted and not dropped
+        :return: false: the new message itself has to be dropped
+        """
+        excess = self.bytes - (old.size() if old is not None else 0) + pdata.size() - self.max_bytes
+        if excess <= 0:
+            return True
+        priority = self._priority(pdata)
+        victims = []
+        for level in sorted(self.levels):
+            if level > priority or (level == priority and self.DROP_POLICY.get(level) == "newest"):
+                break
+            for key in self.levels[level]:
+                if key == pdata.key:
+                    continue
+                victims.append(key)
+                excess -= self.items[key].size()
+                if excess <= 0:
+                    break
+            if excess <= 0:
+                break
+        if excess > 0:
+            return False
+        for key in victims:
+            victim = self._remove(key)
+            self.dropped += 1
+            logger.warning("{} is full, '{}' has been dropped".format(self.name, victim.topic))
+        return True
+
+    def put(self, pdata: PublishData) -> None:
+        """
+        add the message, replacing the pending one of the same topic in place;
+        if it does not fit, the pending one of its topic is dropped with it as it is outdated
+        """
+        old = self.items.get(pdata.key)
+        if not self._make_room(pdata, old):
+            if old is not None:
+                self._remove(pdata.key)
+                self.dropped += 1
+            self.dropped += 1
+            logger.warning("{} is full, '{}' has been dropped".format(self.name, pdata.topic))
+            return
+        if old is not None:
+            self.bytes -= old.size()
+            self.levels[self._priority(old)].pop(pdata.key, None)
+        else:
+            self.arrived[pdata.key] = pdata.created
+        self.items[pdata.key] = pdata
+        self.levels.setdefault(self._priority(pdata), OrderedDict())[pdata.key] = None
+        self.bytes += pdata.size()
+        if self.event is not None:
+            self.event.set()
+
+    def get(self) -> PublishData:
+        """take the oldest pending message"""
+        return self._remove(next(iter(self.items)))
+
+    def oldest_age(self) -> float:
+        """seconds the oldest pending message has been waiting"""
+        if not self.items:
+            return 0.0
+        return time.time() - self.arrived[next(iter(self.items))]
+
+    async def wait(self) -> None:
+        """wait until there is a message"""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.event = asyncio.Event()
+        while not self.items:
+            self.event.clear()
+            await self.event.wait()
 
 class MqttClient:
 
     username: str
     password: str
     url: str
+    port: int = 1883
+    protocol: aiomqtt.ProtocolVersion = aiomqtt.ProtocolVersion.V311
     name: str
     client: aiomqtt.Client
 
     lock = asyncio.Lock()
 
-    queue: Queue = Queue()
+    queue: OutboundQueue = OutboundQueue()
+    spool: Optional[Spool] = None
+    last_publish: float = 0
+    # a standby instance publishes nothing, see lease.py
+    muted: bool = False
+    # gets every published message besides the broker queue, see bus.py
+    fan_out: Optional[Callable[[PublishData], None]] = None
 
     def __init__(self, name: str):
         self.name = name
+        self.pending: Optional[PublishData] = None
+        # running broker sessions and their kind: publish, listen, lease
+        self.sessions: dict[asyncio.Task, str] = {}
+        # kinds of the sessions closed by reconnect(): the publisher does not go offline
+        # and the leader keeps the lease when its session is closed for it
+        self.reconnecting: set[str] = set()
+        self.persistent = True
+        self.command_max_age = 300.0
+        # time the listener has lost the broker, 0 while connected
+        self.listen_lost: float = 0
+        # commands being handled, the listener does not wait for them
+        self.handling: set[asyncio.Task] = set()
+        # keeps the time the listener was last connected over restarts, empty: not kept
+        self.heartbeat_file = ""
 
     def setup(self, config: Config):
         """configure this mqtt client"""
         self.username = config['options']['mqtt_user']
         self.password = config['options']['mqtt_pass']
         self.url = config['options']['MQTTserver']
+        self.port = int(config['options'].get('mqtt_port', 1883))
+        self.protocol = aiomqtt.ProtocolVersion.V5 if config['options'].get('mqtt_v5', False) \
+            else aiomqtt.ProtocolVersion.V311
         self.name = config['options']['mqtt_id']
+        self.persistent = bool(config['options'].get('command_session', True))
+        self.command_max_age = float(config['options'].get('command_max_age', 300))
+        self.heartbeat_file = config['options'].get('command_heartbeat_file', "")
+        MqttClient.queue.max_bytes = int(config['options'].get('outbound_max_kb', 1024)) * 1024
+        spool_dir = config['options'].get('spool_dir')
+        if spool_dir and MqttClient.spool is None:
+            MqttClient.spool = Spool(spool_dir, int(config['options'].get('spool_max_mb', 16)) * 1024 * 1024)
 
     def connect(self):
-        """connect to broker"""
-        self.client = aiomqtt.Client(hostname=self.url, username=self.username, password=self.password, logger=logger)
+        """connect to broker, the will of the leader sets the bridge offline if the connection is lost"""
+        will = None if MqttClient.muted else aiomqtt.Will(AVAILABILITY, "offline", retain=True)
+        self.client = aiomqtt.Client(hostname=self.url, port=self.port, username=self.username, password=self.password,
+                                     protocol=self.protocol, will=will, logger=logger)
         logger.info("mqtt is connected to {}".format(self.url))
 
-    def publish(self, topic: str, payload: str, message: str):
+    def publish(self, topic: str, payload: Union[str, bytes], message: str, retain: bool = False, qos: int = 0):
         """
-        put publish message into queue
+        put publish message into queue, or behind the spooled messages if there are any
         :param topic: topic
-        :param payload: payload
+        :param payload: payload, bytes are sent as they are
         :param message: message
+        :param retain: ask the broker to retain the message
+        :param qos: mqtt qos of the message
+        """
+        if MqttClient.muted:
+            return
+        pdata = PublishData(topic, payload, message, retain, qos=qos)
+        if MqttClient.fan_out is not None:
+            MqttClient.fan_out(pdata)
+        if MqttClient.spool is not None and not MqttClient.spool.empty():
+            MqttClient.spool.append(topic, pdata.payload, message, retain, qos)
+            return
+        MqttClient.queue.put(pdata)
+
+    def reply(self, topic: str, payload: Union[str, bytes], correlation: Optional[bytes]):
+        """
+        answer a request on its mqtt v5 response topic; replies are not spooled, they are useless later
+        :param topic: response topic of the request
+        :param payload: payload
+        :param correlation: correlation data of the request
+        """
+        if MqttClient.muted:
+            return
+        MqttClient.queue.put(PublishData(topic, payload, "reply", correlation=correlation))
+
+    async def _send(self, client: aiomqtt.Client, pdata: PublishData):
+        """publish one message on the connected client"""
+        properties = None
+        if pdata.correlation is not None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.CorrelationData = pdata.correlation
+        await client.publish(pdata.topic, pdata.payload, qos=pdata.qos, retain=pdata.retain, properties=properties)
+        self.last_publish = time.time()
+        logger.info("{}: topic '{}' is published '{}'".format(pdata.message, pdata.topic, pdata.payload))
+
+    def _save(self, pdata: Optional[PublishData]):
+        """move the failed message and everything queued after it to the spool, replies are dropped"""
+        if pdata is not None and pdata.message != "reply":
+            MqttClient.spool.append(pdata.topic, pdata.payload, pdata.message, pdata.retain, pdata.qos)
+        while not MqttClient.queue.empty():
+            queued: PublishData = MqttClient.queue.get()
+            if queued.message != "reply":
+                MqttClient.spool.append(queued.topic, queued.payload, queued.message, queued.retain, queued.qos)
+        if not MqttClient.spool.empty():
+            logger.warning("{} bytes are kept in the spool".format(MqttClient.spool.size()))
+
+    async def _replay(self, client: aiomqtt.Client):
+        """send the spooled messages in order, segments are removed when sent"""
+        count = 0
+        while not MqttClient.spool.empty():
+            for segment, record in MqttClient.spool.replay():
+                if record is None:
+                    # read to its end, a segment of corrupted records only is removed as well
+                    MqttClient.spool.remove(segment)
+                    continue
+                await self._send(client, PublishData(record["t"], record["p"], record["m"], record["r"],
+                                                     qos=record.get("q", 0)))
+                count += 1
+        if count:
+            logger.warning("{} spooled messages have been replayed".format(count))
+
+    async def _session(self, coro: Coroutine, kind: str) -> None:
+        """
+        run one broker session as a task, so reconnect() can end it without ending the caller
+        :param coro: the session
+        :param kind: kind of the session, reconnect() can be limited to some kinds
+        """
+        task = asyncio.create_task(coro)
+        self.sessions[task] = kind
+        try:
+            await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            logger.warning("mqtt session has been closed for reconnect")
+        finally:
+            self.sessions.pop(task, None)
+
+    def reconnect(self, kinds: Optional[set[str]] = None) -> None:
         """
-        MqttClient.queue.put_nowait(PublishData(topic, payload, message))
+        close the running broker sessions, they are opened again with the current settings
+        :param kinds: kinds of the sessions to close, all if None
+        """
+        self.connect()
+        for task, kind in self.sessions.items():
+            if kinds is None or kind in kinds:
+                self.reconnecting.add(kind)
+                task.cancel()
+
+    async def _publish_session(self):
+        """send the spool and the queue on one connection"""
+        async with self.client as client:
+            self.reconnecting.discard("publish")
+            online = not MqttClient.muted
+            if online:
+                await client.publish(AVAILABILITY, "online", retain=True)
+            try:
+                if MqttClient.spool is not None:
+                    await self._replay(client)
+                while True:
+                    if self.pending is None:
+                        await MqttClient.queue.wait()
+                        self.pending = MqttClient.queue.get()
+                    await self._send(client, self.pending)
+                    self.pending = None
+            except asyncio.CancelledError:
+                # the will is not sent on a clean disconnect
+                if online and "publish" not in self.reconnecting:
+                    with contextlib.suppress(aiomqtt.MqttError, asyncio.TimeoutError):
+                        await asyncio.wait_for(client.publish(AVAILABILITY, "offline", retain=True), 1)
+                raise
 
     async def do_publish(self):
         """ do the real publish, process the queue"""
         while True:
-            if MqttClient.queue.empty():
-                await asyncio.sleep(10)
-                continue
-            pdata: PublishData = self.queue.get_nowait()
-            async with self.client as client:
-                await client.publish(pdata.topic, bytearray(pdata.payload, 'utf-8'))
-            logger.info("{}: topic '{}' is published '{}'".format(pdata.message, pdata.topic, pdata.payload))
+            try:
+                await self._session(self._publish_session(), "publish")
+            except aiomqtt.MqttError as mexc:
+                logger.error("mqtt publish error: {}".format(str(mexc)))
+                if MqttClient.spool is not None:
+                    self._save(self.pending)
+                    self.pending = None
+            await asyncio.sleep(1)
+            logger.warning("reconnecting mqtt publisher")
+
+    def _listen_client(self) -> aiomqtt.Client:
+        """
+        client of the listener; with command_session the broker keeps the session and queues the commands
+        while the gateway is away, for command_max_age (mqtt v5 session expiry). If the gateway has been away
+        longer, a clean session is started, the queued commands are too old to be applied. The time of the last
+        connection is kept in command_heartbeat_file over restarts.
+        """
+        if not self.persistent:
+            return aiomqtt.Client(hostname=self.url, port=self.port, username=self.username, password=self.password,
+                                  protocol=self.protocol, logger=logger)
+        # on the first connection of this process the time is taken from the heartbeat of the previous run
+        last = self.listen_lost or self._read_heartbeat()
+        if last:
+            clean = time.time() - last > self.command_max_age
+        else:
+            # age unknown: a mqtt v5 broker expires the session itself, a 3.1.1 session can be of any age
+            clean = self.protocol != aiomqtt.ProtocolVersion.V5
+        if clean:
+            logger.warning("commands queued more than {} secs ago are dropped".format(round(self.command_max_age)))
+        identifier = self.name + "-commands"
+        if self.protocol == aiomqtt.ProtocolVersion.V5:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = int(self.command_max_age)
+            return aiomqtt.Client(hostname=self.url, port=self.port, username=self.username, password=self.password,
+                                  protocol=self.protocol, identifier=identifier, clean_start=clean,
+                                  properties=properties, logger=logger)
+        return aiomqtt.Client(hostname=self.url, port=self.port, username=self.username, password=self.password,
+                              protocol=self.protocol, identifier=identifier, clean_session=clean, logger=logger)
+
+    def _read_heartbeat(self) -> float:
+        """time the listener of the previous run was last connected, 0 if unknown"""
+        if not self.heartbeat_file:
+            return 0
+        try:
+            with open(self.heartbeat_file) as f:
+                return float(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    async def _heartbeat(self):
+        """write the time to the heartbeat file in loop while the listener is connected"""
+        if not self.heartbeat_file:
+            return
+        while True:
+            try:
+                with open(self.heartbeat_file, "w") as f:
+                    f.write(str(time.time()))
+            except OSError as e:
+                logger.error("command heartbeat cannot be written: {}".format(str(e)))
+                return
+            await asyncio.sleep(min(60.0, self.command_max_age / 4))
+
+    async def _listen_session(self, topics: list[str], callback: Callable[..., Coroutine[Any, Any, None]]):
+        """subscribe and process the incoming messages on one connection"""
+        async with self._listen_client() as client:
+            self.listen_lost = 0
+            for topic in topics:
+                await client.subscribe(topic, qos=1 if self.persistent else 0)
+            logger.info("listening: message arrived")
+            heartbeat = asyncio.create_task(self._heartbeat())
+            try:
+                await self._read_commands(client, callback)
+            finally:
+                heartbeat.cancel()
+
+    def _handled(self, task: asyncio.Task) -> None:
+        """forget the finished command and log its failure"""
+        self.handling.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("command handling failed: {}".format(str(task.exception())))
 
-    async def listen(self, topic: str, callback: Callable[[str, str], Coroutine[Any, Any, None]]):
+    async def _read_commands(self, client: aiomqtt.Client, callback: Callable[..., Coroutine[Any, Any, None]]):
+        """
+        pass the incoming messages to the callback, each in its own task so a burst reaches the scheduler at once;
+        the tasks are started in order of arrival, so the commands of a device are queued in order
+        """
+        async for message in client.messages:
+            payload = message.payload.decode("utf-8")
+            if recorder.enabled:
+                recorder.record("command", message.topic.value, payload)
+            reply = None
+            response_topic = getattr(message.properties, 'ResponseTopic', None)
+            if response_topic:
+                reply = (response_topic, getattr(message.properties, 'CorrelationData', None))
+            task = asyncio.create_task(callback(message.topic.value, payload, reply))
+            self.handling.add(task)
+            task.add_done_callback(self._handled)
+
+    async def listen(self, topics: list[str], callback: Callable[..., Coroutine[Any, Any, None]]):
         """
         listens to the subscribed topics
-        :param topic: topic wildcard to listen to
-        :param callback: callback function to handle events
+        :param topics: topic wildcards to listen to
+        :param callback: callback function to handle events, gets topic, payload and the mqtt v5
+                         (response topic, correlation data) of a request or None
         """
 #        async with self.lock:
-        logger.info("listening on '{}'".format(topic))
+        logger.info("listening on '{}'".format(topics))
 
         while True:
             try:
-                async with aiomqtt.Client(hostname=self.url, username=self.username, password=self.password, logger=logger) as client:
-                    await client.subscribe(topic)
-                    logger.info("listening: message arrived")
-                    async for message in client.messages:
-                        mac = message.topic.value.split("/")[1]
-                        await callback(mac, message.payload.decode("utf-8"))
+                await self._session(self._listen_session(topics, callback), "listen")
+            except asyncio.CancelledError:
+                if not self.listen_lost:
+                    self.listen_lost = time.time()
+                raise
             except aiomqtt.MqttError as mexc:
                 logger.error("mqtt error: {}".format(str(mexc)))
             except BaseException as bexc:
                 logger.error("Unexpected mqtt error: {}".format(str(bexc)))
+            if not self.listen_lost:
+                self.listen_lost = time.time()
             await asyncio.sleep(1)
             logger.warning("restarting mqtt listener")
-
-
@@ -0,0 +1,129 @@
+import logging
+import re
+from typing import Optional, TYPE_CHECKING
+
+from config import Config
+
+if TYPE_CHECKING:
+    from device import Device
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Rule:
+    """
+    selection of devices, used by groups and device policies
+    the rule may contain: devices (list of mac addresses), label (regex), type, product, kind, room;
+    a device is selected if it is listed or if it matches every other given item
+    """
+
+    KEYS = ('devices', 'label', 'type', 'product', 'kind', 'room')
+
+    def __init__(self, rule: dict):
+        """
+        init rule
+        :param rule: rule from config, other keys are ignored
+        """
+        self.rule = rule
+        self.label = re.compile(rule['label']) if 'label' in rule else None
+
+    def matches(self, dev: "Device", rooms: Optional[dict[str, set]] = None) -> bool:
+        """
+        check the device
+        :param dev: device to check
+        :param rooms: device ids of the rooms by room label
+        """
+        if dev.mac in self.rule.get('devices', []):
+            return True
+        checks = [key for key in ('label', 'type', 'product', 'kind', 'room') if key in self.rule]
+        if not checks:
+            return False
+        info = dev.data['device info']
+        if self.label and not self.label.search(str(info.get('label', ''))):
+            return False
+        if 'type' in self.rule and info.get('type') != self.rule['type']:
+            return False
+        if 'product' in self.rule and info.get('product type') != self.rule['product']:
+            return False
+        if 'kind' in self.rule and dev.kind != self.rule['kind']:
+            return False
+        if 'room' in self.rule and str(dev.id) not in (rooms or {}).get(self.rule['room'], set()):
+            return False
+        return True
+
+
+class Policy:
+    """settings of one device, the global options overridden by the device_policies matching the device"""
+
+    def __init__(self, publish_interval: Optional[float] = None, qos: int = 0, retain: bool = False,
+                 optimistic: bool = False, topic_prefix: str = "eLan", discovery: bool = True):
+        """
+        init policy
+        :param publish_interval: polling interval of the device, None: publish_interval of the options
+        :param qos: mqtt qos of the states
+        :param retain: ask the broker to retain the states
+        :param optimistic: commands are not confirmed by fetching the state, home assistant assumes it
+        :param topic_prefix: first levels of the device topics
+        :param discovery: announce the device to home assistant
+        """
+        self.publish_interval = publish_interval
+        self.qos = qos
+        self.retain = retain
+        self.optimistic = optimistic
+        self.topic_prefix = topic_prefix
+        self.discovery = discovery
+
+
+class Policies:
+    """
+    include/exclude filters and policy overrides of the devices, compiled into each device when it is set up;
+    filters and policies select devices by rules like groups do (rooms excluded), the policies are applied
+    in their order, so a later policy overrides the fields of an earlier one
+    """
+
+    FIELDS = {
+        "publish_interval": float,
+        "qos": lambda v: min(2, max(0, int(v))),
+        "retain": bool,
+        "optimistic": bool,
+        "topic_prefix": lambda v: str(v).strip("/") or "eLan",
+        "discovery": bool,
+    }
+
+    def __init__(self):
+        self.include: list[Rule] = []
+        self.exclude: list[Rule] = []
+        self.policies: list[tuple[Rule, dict]] = []
+
+    def setup(self, config: Config) -> None:
+        """read device_include, device_exclude and device_policies, invalid fields are ignored"""
+        options = config['options']
+        self.include = [Rule(rule) for rule in options.get('device_include', [])]
+        self.exclude = [Rule(rule) for rule in options.get('device_exclude', [])]
+        self.policies = []
+        for policy in options.get('device_policies', []):
+            fields = {}
+            for field, value in policy.items():
+                if field in Rule.KEYS:
+                    continue
+                try:
+                    fields[field] = self.FIELDS[field](value)
+                except KeyError:
+                    logger.error("unknown policy field '{}' is ignored".format(field))
+                except (ValueError, TypeError):
+                    logger.error("invalid policy field '{}' is ignored: {}".format(field, value))
+            self.policies.append((Rule(policy), fields))
+
+    def included(self, dev: "Device") -> bool:
+        """check the filters, without device_include all devices are included"""
+        if self.include and not any(rule.matches(dev) for rule in self.include):
+            return False
+        return not any(rule.matches(dev) for rule in self.exclude)
+
+    def resolve(self, dev: "Device") -> Policy:
+        """policy of the device"""
+        settings = {}
+        for rule, fields in self.policies:
+            if rule.matches(dev):
+                settings.update(fields)
+        return Policy(**settings)
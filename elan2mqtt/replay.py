@@ -0,0 +1,335 @@
+"""
+replay a capture file (see capture_file option) against a fake eLan gateway and a fake broker
+
+    python3 replay.py capture.jsonl.gz --speed 10
+
+the bridge runs in this process with the given config, pointed to the fakes;
+websocket events are injected as the websocket listener would do, commands are published to the broker.
+At the end the latency from each command to the next state of its device and the bridge metrics are printed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import capture
+import elan2mqtt
+import metrics
+from config import Config
+from elan_logger import set_logger
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Clock:
+    """replay time, capture time running at the given speed"""
+
+    def __init__(self, start: float, speed: float):
+        self.start = start
+        self.speed = speed
+        self.started = time.monotonic()
+
+    def now(self) -> float:
+        """current time of the capture"""
+        return self.start + (time.monotonic() - self.started) * self.speed
+
+    def delay(self, t: float) -> float:
+        """real seconds until the capture time t"""
+        return (t - self.now()) / self.speed
+
+
+class FakeGateway:
+    """
+    eLan http api answering from the capture: a GET gets the latest body recorded for the path
+    until the replay time, a PUT gets the next recorded result of the path;
+    urls of the captured gateway in the bodies are pointed to the fake one
+    """
+
+    URL = re.compile(r'https?://[^/"]+')
+
+    def __init__(self, records: list, clock: Clock):
+        self.clock = clock
+        self.bodies: dict[str, list] = {}
+        self.results: dict[str, list] = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        for t, kind, key, data in records:
+            if kind == "get":
+                self.bodies.setdefault(key, []).append((t, data))
+            elif kind == "put":
+                self.results.setdefault(key, []).append(data["result"])
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.base = ""
+
+    def get(self, path: str) -> Optional[str]:
+        bodies = self.bodies.get(path)
+        if not bodies:
+            return None
+        now = self.clock.now()
+        body = bodies[0][1]
+        for t, data in bodies:
+            if t > now:
+                break
+            body = data
+        return self.URL.sub(self.base, body)
+
+    def put(self, path: str) -> str:
+        with self.lock:
+            results = self.results.get(path)
+            return results.pop(0) if results else "{}"
+
+    def start(self, port: int) -> None:
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self, code: int, body: str, headers: dict = None):
+                data = body.encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._answer(200, "{}", {"Set-Cookie": "AuthAPI=replay"})
+
+            def do_GET(self):
+                gateway.requests += 1
+                body = gateway.get(self.path)
+                if body is None:
+                    self._answer(404, '{"error": {"message": "not captured"}}')
+                else:
+                    self._answer(200, body)
+
+            def do_PUT(self):
+                gateway.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._answer(200, gateway.put(self.path))
+
+            def log_message(self, *args):
+                pass
+
+        self.base = "http://127.0.0.1:{}".format(port)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="fake-gateway", daemon=True).start()
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """mqtt wildcard match"""
+    p_parts = pattern.split("/")
+    t_parts = topic.split("/")
+    for i, p in enumerate(p_parts):
+        if p == "#":
+            return True
+        if i >= len(t_parts) or (p != "+" and p != t_parts[i]):
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+class FakeBroker:
+    """
+    minimal mqtt 3.1.1 broker: qos 0 and 1, retained messages, no authentication;
+    it measures the time from each command to the next state of the same device
+    """
+
+    def __init__(self):
+        self.clients: dict[asyncio.StreamWriter, list[str]] = {}
+        self.retained: dict[str, bytes] = {}
+        self.counts: dict[str, int] = {}
+        self.commands: dict[str, list[float]] = {}
+        self.latency = metrics.Metric(100000)
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    @staticmethod
+    def _packet(header: int, body: bytes) -> bytes:
+        length = len(body)
+        encoded = bytearray()
+        while True:
+            digit = length % 128
+            length //= 128
+            encoded.append(digit | (0x80 if length else 0))
+            if not length:
+                break
+        return bytes([header]) + bytes(encoded) + body
+
+    @staticmethod
+    def _string(data: bytes, pos: int) -> tuple[str, int]:
+        size = struct.unpack_from("!H", data, pos)[0]
+        return data[pos + 2:pos + 2 + size].decode(), pos + 2 + size
+
+    def route(self, topic: str, payload: bytes, retain: bool = False) -> None:
+        """deliver a message to the subscribers"""
+        kind = topic.split("/")[-1]
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        parts = topic.split("/")
+        if parts[0] == "eLan" and len(parts) == 3:
+            if parts[2] == "command":
+                self.commands.setdefault(parts[1], []).append(time.monotonic())
+            elif parts[2] == "status" and self.commands.get(parts[1]):
+                for sent in self.commands.pop(parts[1]):
+                    self.latency.add(time.monotonic() - sent)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        packet = self._packet(0x30, struct.pack("!H", len(topic.encode())) + topic.encode() + payload)
+        for writer, patterns in self.clients.items():
+            if any(topic_matches(p, topic) for p in patterns):
+                writer.write(packet)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.clients[writer] = []
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, multiplier = 0, 1
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    length += (digit & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not digit & 0x80:
+                        break
+                data = await reader.readexactly(length)
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic, pos = self._string(data, 0)
+                    if qos:
+                        writer.write(b"\x40\x02" + data[pos:pos + 2])
+                        pos += 2
+                    self.route(topic, data[pos:], bool(header & 1))
+                elif kind == 8:  # SUBSCRIBE
+                    pid, pos, granted = data[:2], 2, bytearray()
+                    while pos < len(data):
+                        pattern, pos = self._string(data, pos)
+                        granted.append(min(data[pos], 1))
+                        pos += 1
+                        self.clients[writer].append(pattern)
+                        for topic, payload in self.retained.items():
+                            if topic_matches(pattern, topic):
+                                writer.write(self._packet(
+                                    0x31, struct.pack("!H", len(topic.encode())) + topic.encode() + payload))
+                    writer.write(self._packet(0x90, pid + bytes(granted)))
+                elif kind == 10:  # UNSUBSCRIBE
+                    writer.write(b"\xb0\x02" + data[:2])
+                elif kind == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def start(self, port: int) -> None:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+
+    async def stop(self) -> None:
+        """close the server and disconnect the clients"""
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+            await self.server.wait_closed()
+            await asyncio.sleep(0.1)
+
+
+async def replay(records: list, config: Config, speed: float, http_port: int, mqtt_port: int, drain: float):
+    """
+    run the bridge against the fakes and feed it the captured events and commands
+    """
+    records.sort(key=lambda r: r[0])
+    clock = Clock(records[0][0], speed)
+    gateway = FakeGateway(records, clock)
+    broker = FakeBroker()
+    gateway.start(http_port)
+    await broker.start(mqtt_port)
+
+    config['options'].update({
+        "eLanURL": "http://127.0.0.1:{}".format(http_port),
+        "MQTTserver": "127.0.0.1",
+        "mqtt_port": mqtt_port,
+        "disable_websocket": True,
+        "capture_file": "",
+        "spool_dir": "",
+        "health_port": 0,
+        "inventory_interval": 0,
+        "config_check_interval": 3600,
+    })
+    elan2mqtt.start(config)
+    bridge = asyncio.create_task(elan2mqtt.main(), name="bridge")
+
+    fed = 0
+    events: list[asyncio.Task] = []
+    started = time.monotonic()
+    for t, kind, key, data in records:
+        if kind not in ("event", "command"):
+            continue
+        delay = clock.delay(t)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if kind == "event":
+            dev = elan2mqtt.device_hash.get(key)
+            if dev is not None:
+                # as the websocket of the gateway does, see elan_ws
+                events.append(asyncio.create_task(dev.refresh()))
+        else:
+            broker.route(key, data.encode())
+        fed += 1
+    await asyncio.sleep(drain)
+    elapsed = time.monotonic() - started
+
+    bridge.cancel()
+    try:
+        await bridge
+    except asyncio.CancelledError:
+        pass
+    await broker.stop()
+    await asyncio.to_thread(gateway.stop)
+    print(json.dumps({
+        "records": len(records),
+        "fed": fed,
+        "elapsed": round(elapsed, 3),
+        "capture_span": round(records[-1][0] - records[0][0], 3),
+        "gateway_requests": gateway.requests,
+        "broker_messages": broker.counts,
+        "command_to_state": broker.latency.summary(),
+        "unconfirmed_commands": sum(len(v) for v in broker.commands.values()),
+        "outbound_dropped": elan2mqtt.mqtt.queue.dropped,
+        "metrics": metrics.summary(),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="replay captured eLan traffic through the bridge")
+    parser.add_argument("capture", help="capture file written with the capture_file option")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, e.g. 1, 10, 100")
+    parser.add_argument("--config", default="config.json", help="bridge config")
+    parser.add_argument("--http-port", type=int, default=18080, help="port of the fake gateway")
+    parser.add_argument("--mqtt-port", type=int, default=11883, help="port of the fake broker")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait after the last record")
+    args = parser.parse_args()
+
+    replay_config = Config(args.config)
+    set_logger(replay_config)
+    asyncio.run(replay(capture.load(args.capture), replay_config, args.speed, args.http_port, args.mqtt_port,
+                       args.drain))
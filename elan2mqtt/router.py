@@ -0,0 +1,72 @@
+import logging
+import re
+import time
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# gets the payload, may return an awaitable
+Handler = Callable[[str], Optional[Awaitable[None]]]
+# mqtt v5 response topic and correlation data of a request
+Reply = tuple[str, Optional[bytes]]
+# gets the payload and the reply of the request, if any
+RequestHandler = Callable[[str, Optional[Reply]], Awaitable[None]]
+
+
+def alias(label: str) -> str:
+    """topic friendly form of a device label, e.g. 'Kitchen Light' -> 'kitchen_light'"""
+    return re.sub(r'[^a-z0-9]+', '_', label.lower()).strip('_')
+
+
+class Router:
+    """
+    dispatches incoming messages by their full topic, the table is built when devices or groups change;
+    messages on unknown topics are counted and reported at most once per report interval
+    """
+
+    def __init__(self):
+        self.routes: dict[str, Handler] = {}
+        self.requests: dict[str, RequestHandler] = {}
+        self.unknown = 0
+        self.last_unknown: Optional[str] = None
+        self.last_report: float = 0
+        self.report_interval = 60.0
+
+    def build(self, routes: dict[str, Handler], requests: Optional[dict[str, RequestHandler]] = None) -> None:
+        """
+        replace the routing table
+        :param routes: handler of each topic
+        :param requests: handler of each request topic, it gets the reply of the request too
+        """
+        self.routes = routes
+        self.requests = requests or {}
+        logger.info("{} topics are routed".format(len(self.routes) + len(self.requests)))
+
+    async def dispatch(self, topic: str, payload: str, reply: Optional[Reply] = None) -> None:
+        """
+        handle one message
+        :param topic: topic the message has been received on
+        :param payload: payload of the message
+        :param reply: response topic and correlation data of a mqtt v5 request
+        """
+        handler = self.routes.get(topic)
+        if handler is None:
+            request = self.requests.get(topic)
+            if request is None:
+                self._unknown(topic)
+            else:
+                await request(payload, reply)
+            return
+        result = handler(payload)
+        if result is not None:
+            await result
+
+    def _unknown(self, topic: str) -> None:
+        self.unknown += 1
+        self.last_unknown = topic
+        now = time.monotonic()
+        if now - self.last_report < self.report_interval:
+            return
+        self.last_report = now
+        logger.error("{} messages on unknown topics, last: {}".format(self.unknown, topic))
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from typing import Any, Optional
+
+import metrics
+from config import Config
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class CommandScheduler:
+    """
+    paces commands sent to the eLan RF side
+    commands are queued per device and taken round robin, up to concurrency of them in flight
+    but never two of the same device, so the commands of a device keep their order;
+    the starts are limited by a token bucket (rate per second, burst size)
+    """
+
+    def __init__(self):
+        self.rate: float = 0
+        self.burst: float = 1
+        self.tokens: float = 1
+        self.concurrency: int = 1
+        self.running: set[str] = set()
+        self.updated: float = time.monotonic()
+        self.queues: OrderedDict[str, deque] = OrderedDict()
+        self.wakeup: Optional[asyncio.Event] = None
+
+    def setup(self, config: Config) -> None:
+        """configure this scheduler"""
+        self.rate = float(config['options'].get('command_rate', 0))
+        self.burst = max(1.0, float(config['options'].get('command_burst', 1)))
+        self.tokens = self.burst
+        self.concurrency = max(1, int(config['options'].get('command_concurrency', 1)))
+        logger.info("command rate: {}/s, burst: {}, concurrency: {}".format(self.rate or "unlimited", self.burst,
+                                                                            self.concurrency))
+
+    async def submit(self, key: str, func: Callable, *args) -> Any:
+        """
+        queue a command and wait for its result
+        :param key: device the command belongs to
+        :param func: blocking function sending the command
+        :param args: arguments of func
+        :return: result of func
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append((time.monotonic(), func, args, future))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return await future
+
+    def pending(self) -> int:
+        """number of queued commands"""
+        return sum(len(q) for q in self.queues.values())
+
+    async def _take_token(self) -> None:
+        """wait until the bucket allows the next command"""
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def _ready(self) -> bool:
+        """true if a command may be started now, ignoring the token bucket"""
+        return len(self.running) < self.concurrency and any(key not in self.running for key in self.queues)
+
+    def _next(self) -> tuple:
+        """take the oldest command of the next device in turn that has no command in flight"""
+        key, queue = next((key, queue) for key, queue in self.queues.items() if key not in self.running)
+        item = queue.popleft()
+        if queue:
+            self.queues.move_to_end(key)
+        else:
+            del self.queues[key]
+        return key, item
+
+    async def _send(self, key: str, item: tuple) -> None:
+        """
+        send one command and resolve its future
+        :param key: device the command belongs to
+        :param item: queued command
+        """
+        queued, func, args, future = item
+        started = time.monotonic()
+        metrics.metric("command_wait").add(started - queued)
+        try:
+            future.set_result(await asyncio.to_thread(func, *args))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as be:
+            if not future.done():
+                future.set_exception(be)
+        finally:
+            self.running.discard(key)
+            self.wakeup.set()
+        metrics.metric("command_time").add(time.monotonic() - queued)
+        logger.debug("command waited {:.3f} s, {} pending".format(started - queued, self.pending()))
+
+    async def run(self) -> None:
+        """send the queued commands"""
+        self.wakeup = asyncio.Event()
+        self.running = set()
+        async with asyncio.TaskGroup() as tg:
+            while True:
+                if not self._ready():
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                await self._take_token()
+                key, item = self._next()
+                if item[3].done():
+                    continue
+                self.running.add(key)
+                tg.create_task(self._send(key, item))
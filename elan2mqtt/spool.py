@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import time
+from collections.abc import Iterator
+from typing import Optional
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """
+    append-only segment files keeping unsent messages over broker outages and restarts
+    each record is one json line: topic, payload, message, retain and time of creation;
+    segments are replayed oldest first and deleted once all their records are sent
+    """
+
+    def __init__(self, path: str, max_bytes: int, segment_bytes: int = 1024 * 1024):
+        """
+        open the spool, existing segments are kept for replay
+        :param path: directory of the segment files
+        :param max_bytes: disk space limit, compaction is started above it
+        :param segment_bytes: size of one segment
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max(1, max_bytes // 4))
+        os.makedirs(path, exist_ok=True)
+        self.sizes: dict[int, int] = {}
+        for name in os.listdir(path):
+            if name.endswith(".spool"):
+                self.sizes[int(name[:-6])] = os.path.getsize(os.path.join(path, name))
+        self.current = max(self.sizes, default=0)
+        self.file = None
+        if self.sizes:
+            logger.warning("spool contains {} bytes to replay".format(self.size()))
+
+    def _name(self, segment: int) -> str:
+        return os.path.join(self.path, "{:08d}.spool".format(segment))
+
+    def size(self) -> int:
+        """bytes kept in the spool"""
+        return sum(self.sizes.values())
+
+    def empty(self) -> bool:
+        return not any(self.sizes.values())
+
+    def append(self, topic: str, payload, message: str, retain: bool = False, qos: int = 0) -> None:
+        """
+        store one message at the end of the spool
+        :param topic: topic
+        :param payload: payload, str or utf-8 bytes
+        :param message: message
+        :param retain: retain flag
+        :param qos: mqtt qos
+        """
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8", errors="replace")
+        self._write({"t": topic, "p": payload, "m": message, "r": retain, "q": qos, "ts": time.time()})
+        if self.size() > self.max_bytes:
+            self.compact()
+
+    def _write(self, record: dict) -> None:
+        line = (json.dumps(record) + "\n").encode()
+        if self.file is None or self.sizes.get(self.current, 0) >= self.segment_bytes:
+            self.seal()
+            self.current += 1
+            self.sizes[self.current] = 0
+            self.file = open(self._name(self.current), "ab")
+        self.file.write(line)
+        self.file.flush()
+        self.sizes[self.current] += len(line)
+
+    def seal(self) -> None:
+        """close the segment being written, new messages go to a new one"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _read(self, segment: int) -> Iterator[dict]:
+        try:
+            f = open(self._name(segment), "rb")
+        except FileNotFoundError:
+            # removed by a compaction meanwhile
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.error("corrupted record in spool segment {}".format(segment))
+
+    def replay(self) -> Iterator[tuple[int, Optional[dict]]]:
+        """
+        records in the order they were appended, the segment being written is sealed first;
+        the end of each segment is marked by a None record, also if it had no valid record at all
+        :return: segment number and record
+        """
+        self.seal()
+        for segment in sorted(self.sizes):
+            for record in self._read(segment):
+                yield segment, record
+            yield segment, None
+
+    def remove(self, segment: int) -> None:
+        """delete a segment which has been sent completely"""
+        if segment == self.current:
+            self.seal()
+        self.sizes.pop(segment, None)
+        try:
+            os.remove(self._name(segment))
+        except FileNotFoundError:
+            pass
+
+    def compact(self) -> None:
+        """
+        keep the latest message of each topic only, in the order of their last update;
+        if it is still over the limit the oldest segments are dropped
+        """
+        before = self.size()
+        latest: dict[str, dict] = {}
+        old = sorted(self.sizes)
+        for _, record in self.replay():
+            if record is None:
+                continue
+            latest.pop(record["t"], None)
+            latest[record["t"]] = record
+        for segment in old:
+            self.remove(segment)
+        for record in latest.values():
+            self._write(record)
+        while self.size() > self.max_bytes and len(self.sizes) > 1:
+            dropped = min(self.sizes)
+            logger.error("spool is full, dropping segment {}".format(dropped))
+            self.remove(dropped)
+        logger.warning("spool compacted from {} to {} bytes".format(before, self.size()))
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from collections.abc import Callable, Coroutine
+from typing import Any, Optional
+
+from config import Config
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Subsystem:
+    """one supervised task and its restart policy"""
+
+    def __init__(self, name: str, factory: Callable[[], Coroutine[Any, Any, None]], policy: str):
+        """
+        init subsystem
+        :param name: name of the task
+        :param factory: creates the coroutine of the task
+        :param policy: transient: restart on failure, escalate: failure stops the supervisor,
+                       temporary: never restart
+        """
+        self.name = name
+        self.factory = factory
+        self.policy = policy
+        self.task: Optional[asyncio.Task] = None
+        self.failures = 0
+        self.restarts = 0
+        self.requested = False
+        self.enabled = True
+
+
+class Supervisor:
+    """
+    runs the subsystems as separate tasks, a failed task is restarted alone after a backoff,
+    the state held outside of the task (devices, login, mqtt queue) is kept
+    """
+
+    def __init__(self):
+        self.subsystems: dict[str, Subsystem] = {}
+        self.backoff_min = 1.0
+        self.backoff_max = 300.0
+        # a task running this long is considered healthy again
+        self.stable_time = 60.0
+
+    def setup(self, config: Config) -> None:
+        """configure restart backoff"""
+        self.backoff_min = float(config['options'].get('restart_backoff_min', 1))
+        self.backoff_max = float(config['options'].get('restart_backoff_max', 300))
+
+    def add(self, name: str, factory: Callable[[], Coroutine[Any, Any, None]], policy: str = "transient",
+            enabled: bool = True) -> None:
+        """
+        register a subsystem, it is started by run()
+        :param name: name of the task
+        :param factory: creates the coroutine of the task
+        :param policy: restart policy, see Subsystem
+        :param enabled: false: registered only, started by start()
+        """
+        sub = Subsystem(name, factory, policy)
+        sub.enabled = enabled
+        self.subsystems[name] = sub
+
+    def restart(self, name: str) -> None:
+        """restart the subsystem now, a subsystem which is not registered is ignored"""
+        sub = self.subsystems.get(name)
+        if sub is None:
+            logger.warning("{} cannot be restarted, it is not running".format(name))
+            return
+        if sub.task is not None and not sub.task.done():
+            logger.warning("restarting {}".format(name))
+            sub.requested = True
+            sub.task.cancel()
+
+    def stop(self, name: str) -> None:
+        """stop the subsystem until start() is called"""
+        sub = self.subsystems[name]
+        sub.enabled = False
+        if sub.task is not None and not sub.task.done():
+            logger.warning("stopping {}".format(name))
+            sub.requested = True
+            sub.task.cancel()
+
+    def start(self, name: str) -> None:
+        """start a stopped subsystem"""
+        self.subsystems[name].enabled = True
+
+    def status(self) -> dict:
+        """state of the subsystems"""
+        return {name: {"running": sub.task is not None and not sub.task.done(),
+                       "restarts": sub.restarts, "failures": sub.failures}
+                for name, sub in self.subsystems.items()}
+
+    async def _supervise(self, sub: Subsystem) -> None:
+        """run one subsystem according to its policy"""
+        while True:
+            while not sub.enabled:
+                await asyncio.sleep(1)
+            started = time.monotonic()
+            sub.requested = False
+            sub.task = asyncio.create_task(sub.factory(), name=sub.name)
+            try:
+                await sub.task
+                logger.info("{} has finished".format(sub.name))
+                return
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling() or not sub.requested:
+                    raise
+                sub.restarts += 1
+                continue
+            except BaseException as be:
+                if sub.policy == "escalate":
+                    raise
+                logger.error("{} has failed: {}".format(sub.name, str(be)), exc_info=be)
+                if sub.policy == "temporary":
+                    return
+            if time.monotonic() - started > self.stable_time:
+                sub.failures = 0
+            sub.failures += 1
+            sub.restarts += 1
+            delay = min(self.backoff_max, self.backoff_min * 2 ** (sub.failures - 1))
+            logger.warning("restarting {} in {} s".format(sub.name, delay))
+            await asyncio.sleep(delay)
+
+    async def run(self) -> None:
+        """run all subsystems, returns when all have finished, raises if an escalating one fails"""
+        async with asyncio.TaskGroup() as group:
+            for sub in self.subsystems.values():
+                group.create_task(self._supervise(sub), name="supervise-" + sub.name)
+            logger.info("all tasks have been created {}".format(list(self.subsystems)))
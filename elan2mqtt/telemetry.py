@@ -0,0 +1,149 @@
+import logging
+import math
+import time
+from array import array
+from typing import Optional
+
+from config import Config
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Ring:
+    """
+    fixed size history of the numeric state attributes of one device
+    the sample times are shared, each attribute has its own array of values, NaN if missing in a sample
+    """
+
+    def __init__(self, size: int):
+        """
+        init ring
+        :param size: number of samples kept
+        """
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values: dict[str, array] = {}
+        self.head = 0
+        self.count = 0
+
+    def add(self, t: float, sample: dict[str, float]) -> None:
+        """
+        store one sample, overwriting the oldest one if the ring is full
+        :param t: time of the sample
+        :param sample: numeric attributes of the state
+        """
+        pos = self.head
+        self.times[pos] = t
+        for attr in sample:
+            if attr not in self.values:
+                self.values[attr] = array('d', [math.nan]) * self.size
+        for attr, values in self.values.items():
+            values[pos] = sample.get(attr, math.nan)
+        self.head = (pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def positions(self) -> range:
+        """positions of the kept samples, oldest first"""
+        start = (self.head - self.count) % self.size
+        return range(start, start + self.count)
+
+    def downsample(self, attr: str, since: float, until: float, buckets: int) -> list:
+        """
+        min, max and avg of an attribute in equal time buckets
+        :param attr: state attribute
+        :param since: start of the first bucket
+        :param until: end of the last bucket
+        :param buckets: number of buckets
+        :return: [start, min, max, avg, count] of the buckets having samples
+        """
+        values = self.values.get(attr)
+        if values is None or until <= since:
+            return []
+        width = (until - since) / buckets
+        lows = [math.inf] * buckets
+        highs = [-math.inf] * buckets
+        sums = [0.0] * buckets
+        counts = [0] * buckets
+        times = self.times
+        size = self.size
+        for pos in self.positions():
+            pos %= size
+            t = times[pos]
+            value = values[pos]
+            if t < since or t >= until or value != value:
+                continue
+            i = int((t - since) / width)
+            counts[i] += 1
+            sums[i] += value
+            if value < lows[i]:
+                lows[i] = value
+            if value > highs[i]:
+                highs[i] = value
+        return [[round(since + i * width, 3), lows[i], highs[i], round(sums[i] / counts[i], 4), counts[i]]
+                for i in range(buckets) if counts[i]]
+
+
+class Telemetry:
+    """
+    recent history of numeric device readings (temperatures, ...) kept in memory, queried over mqtt
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.kinds: list[str] = []
+        self.max_buckets = 500
+        self.rings: dict[str, Ring] = {}
+
+    def setup(self, config: Config) -> None:
+        """configure history size and recorded device kinds, a change of the size drops the history"""
+        size = int(config['options'].get('telemetry_size', 1440))
+        self.kinds = config['options'].get('telemetry_kinds', ["thermometer", "thermostat", "regulator"])
+        if size != self.size:
+            self.rings.clear()
+        self.size = size
+
+    def wants(self, kind: str) -> bool:
+        """true if the readings of devices of the kind are recorded"""
+        return self.size > 0 and kind in self.kinds
+
+    def record(self, key: str, state: dict, t: Optional[float] = None) -> None:
+        """
+        store the numeric attributes of a device state
+        :param key: device mac
+        :param state: parsed device state
+        :param t: time of the state, now by default
+        """
+        sample = {attr: float(value) for attr, value in state.items()
+                  if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        if not sample:
+            return
+        if key not in self.rings:
+            self.rings[key] = Ring(self.size)
+        self.rings[key].add(time.time() if t is None else t, sample)
+
+    def query(self, key: str, request: dict) -> dict:
+        """
+        downsampled history of a device
+        :param key: device mac
+        :param request: optional: attributes (list), since (seconds back, default all), buckets (default 60), id
+        :return: {id, since, until, attributes: {attribute: [[start, min, max, avg, count], ...]}}
+        :raise ValueError: invalid request
+        """
+        ring = self.rings.get(key)
+        until = time.time()
+        since = until - float(request.get('since', 0) or 0)
+        if ring is not None and ring.count and 'since' not in request:
+            since = ring.times[ring.positions()[0] % ring.size]
+        buckets = max(1, min(self.max_buckets, int(request.get('buckets', 60))))
+        attributes = request.get('attributes') or (list(ring.values) if ring is not None else [])
+        if not isinstance(attributes, list):
+            raise ValueError("attributes is not a list")
+        result = {
+            "since": round(since, 3),
+            "until": round(until, 3),
+            "attributes": {attr: ring.downsample(attr, since, until + 0.001, buckets) if ring is not None else []
+                           for attr in attributes},
+        }
+        if 'id' in request:
+            result['id'] = request['id']
+        return result
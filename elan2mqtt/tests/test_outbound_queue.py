@@ -0,0 +1,70 @@
+from mqtt_client import OutboundQueue, PublishData
+
+
+def message(topic: str, size: int, kind: str = "status") -> PublishData:
+    """message taking size bytes in the queue"""
+    return PublishData(topic, "x" * (size - len(topic)), kind)
+
+
+def test_replacement_keeps_the_cap():
+    queue = OutboundQueue(200)
+    queue.put(message("a", 100))
+    queue.put(message("a", 5000))
+    assert queue.bytes <= 200
+    assert len(queue) == 0
+    assert queue.dropped == 2
+
+
+def test_replacement_evicts_lower_priority():
+    queue = OutboundQueue(200)
+    queue.put(message("m", 100, "metrics"))
+    queue.put(message("a", 50))
+    queue.put(message("a", 150))
+    assert list(queue.items) == ["a"]
+    assert queue.bytes == 150
+    assert queue.dropped == 1
+
+
+def test_replacement_keeps_its_place():
+    queue = OutboundQueue(200)
+    queue.put(message("a", 50))
+    queue.put(message("b", 50))
+    queue.put(message("a", 60))
+    assert list(queue.items) == ["a", "b"]
+    assert queue.bytes == 110
+
+
+def test_nothing_is_evicted_for_a_message_that_cannot_fit():
+    queue = OutboundQueue(200)
+    for topic in ("a", "b", "c"):
+        queue.put(message(topic, 10))
+    queue.put(message("d", 100, "discovery"))
+    queue.put(message("e", 163))
+    assert list(queue.items) == ["a", "b", "c", "d"]
+    assert queue.bytes == 130
+    assert queue.dropped == 1
+
+
+def test_oldest_of_the_same_priority_is_dropped():
+    queue = OutboundQueue(200)
+    for topic in ("a", "b", "c"):
+        queue.put(message(topic, 60))
+    queue.put(message("d", 60))
+    assert list(queue.items) == ["b", "c", "d"]
+    assert queue.dropped == 1
+
+
+def test_newest_policy_drops_the_incoming_message():
+    queue = OutboundQueue(100)
+    queue.put(message("a", 60, "metrics"))
+    queue.put(message("b", 60, "metrics"))
+    assert list(queue.items) == ["a"]
+    assert queue.dropped == 1
+
+
+def test_higher_priority_is_never_evicted():
+    queue = OutboundQueue(100)
+    queue.put(message("a", 60, "error"))
+    queue.put(message("b", 60, "discovery"))
+    assert list(queue.items) == ["a"]
+    assert queue.bytes == 60
@@ -0,0 +1,128 @@
+import json
+import logging
+import math
+from collections.abc import Callable
+from typing import Any
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class CommandError(ValueError):
+    """command cannot be sent to the device"""
+    pass
+
+
+class CommandValidator:
+    """
+    checks commands against the 'actions info' of one device
+    the checks are compiled once, validation itself is a dict lookup and a comparison per action
+    """
+
+    def __init__(self, actions_info: dict, primary_actions: list, clamp: bool = False):
+        """
+        compile the validator
+        :param actions_info: 'actions info' of the device
+        :param primary_actions: 'primary actions' of the device
+        :param clamp: true: fix out of range values, false: reject them
+        """
+        self.clamp = clamp
+        self.checks: dict[str, Callable[[Any], Any]] = {}
+        for action, info in actions_info.items():
+            self.checks[action] = self._compile(action, info or {})
+        self.primary = None
+        for action in primary_actions:
+            if action in self.checks:
+                self.primary = action
+                break
+
+    def _compile(self, action: str, info: dict) -> Callable[[Any], Any]:
+        """
+        create the check of one action
+        :param action: name of the action
+        :param info: type and limits of the action
+        :return: function returning the accepted value or raising CommandError
+        """
+        a_type = info.get('type')
+        clamp = self.clamp
+
+        if a_type == 'bool':
+            def check_bool(value):
+                if isinstance(value, bool):
+                    return value
+                if clamp and value in (0, 1):
+                    return bool(value)
+                raise CommandError("'{}' expects bool, got {}".format(action, json.dumps(value)))
+            return check_bool
+
+        if a_type in ('int', 'number'):
+            low = info.get('min')
+            high = info.get('max')
+            integer = a_type == 'int'
+
+            def check_number(value):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise CommandError("'{}' expects {}, got {}".format(action, a_type, json.dumps(value)))
+                # json accepts NaN and Infinity, they are neither clamped nor sent
+                if not math.isfinite(value):
+                    raise CommandError("'{}' expects a finite {}, got {}".format(action, a_type, value))
+                if integer and value != int(value):
+                    if not clamp:
+                        raise CommandError("'{}' expects int, got {}".format(action, value))
+                    value = round(value)
+                if integer:
+                    value = int(value)
+                if low is not None and value < low:
+                    if not clamp:
+                        raise CommandError("'{}' is below {}: {}".format(action, low, value))
+                    value = low
+                if high is not None and value > high:
+                    if not clamp:
+                        raise CommandError("'{}' is above {}: {}".format(action, high, value))
+                    value = high
+                return value
+            return check_number
+
+        # actions without argument and unknown types are passed as they are
+        return lambda value: value
+
+    def _parse(self, data: str) -> dict:
+        """
+        parse the command, bare values are applied to the primary action
+        :param data: command payload
+        :return: command as dict
+        """
+        try:
+            command = json.loads(data)
+        except ValueError:
+            text = data.strip().lower()
+            if text in ('on', 'off'):
+                command = text == 'on'
+            else:
+                raise CommandError("command is not a valid json: {}".format(data))
+        if isinstance(command, dict):
+            return command
+        if self.primary is None:
+            raise CommandError("device has no primary action for {}".format(data))
+        return {self.primary: command}
+
+    def validate(self, data: str) -> str:
+        """
+        validate a command
+        :param data: command payload
+        :return: command to send, the original payload if it did not need any fix
+        """
+        command = self._parse(data)
+        if not command:
+            raise CommandError("empty command")
+        result = {}
+        changed = not data.lstrip().startswith('{')
+        for action, value in command.items():
+            check = self.checks.get(action)
+            if check is None:
+                raise CommandError("unknown action '{}'".format(action))
+            result[action] = check(value)
+            changed = changed or type(result[action]) is not type(value) or result[action] != value
+        if not changed:
+            return data
+        logger.debug("command {} has been changed to {}".format(data, result))
+        return json.dumps(result)